@@ -4,15 +4,25 @@ import hashlib
 import json
 import base64
 import os
+import html
 from datetime import datetime
 from PIL import Image
 import io
 import bcrypt
 import time
 import random
+import queue
+import mmap
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
-from streamlit_autorefresh import st_autorefresh
 import uuid
+import sys
+import argparse
+import tempfile
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -131,11 +141,155 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Enhanced Database setup
-def init_database():
-    conn = sqlite3.connect('chat_app_pro.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
+# Database configuration
+class ChatConfig:
+    DB_PATH = 'chat_app_pro.db'
+    POOL_SIZE = 8  # idle connections kept open per process
+    # Applied to every new connection. WAL lets the refresh readers run
+    # while a message is being written.
+    PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # ms to wait for a lock before "database is locked"
+        'cache_size': -16000,  # KiB of page cache per connection
+        'mmap_size': 256 * 1024 * 1024,
+    }
+    MESSAGE_CACHE_LIMIT = 500  # messages kept per conversation in a session
+    HISTORY_PAGE_SIZE = 50  # messages per "load older" page
+    ATTACHMENT_DIR = 'chat_attachments'  # relative to the database file
+    THUMBNAIL_SIZES = (300,)  # longest edge in pixels; the last one is displayed
+    THUMBNAIL_FORMAT = 'WEBP'
+    THUMBNAIL_QUALITY = 80
+    THUMBNAIL_WORKERS = 2
+    THUMBNAIL_CACHE_BYTES = 32 * 1024 * 1024  # shared by all sessions
+    RENDER_CACHE_BYTES = 8 * 1024 * 1024  # pre-rendered message HTML, shared by all sessions
+    PROFILE_CACHE_SECONDS = 30  # profile rows served from cache for this long
+    PROFILE_VIEW_FLUSH_SECONDS = 30  # buffered profile views are written this often
+    RECOMMENDATION_WEIGHTS = {'mutual_friends': 3, 'shared_interests': 2, 'interaction_strength': 1}
+    RECOMMENDATION_INTEREST_LEADERS = 5  # most viewed users suggested per shared interest
+    RECOMMENDATION_KEEP = 50  # candidates per user kept by a rebuild
+    FRIEND_CACHE_SECONDS = 60  # friend sets are reloaded at least this often
+    WRITE_BEHIND = False  # queue messages for a background group-committing writer
+    WRITE_BATCH_SIZE = 64
+    PRESENCE_TTL_SECONDS = 120  # users without a heartbeat for this long are offline
+    PRESENCE_SNAPSHOT_SECONDS = 15
+    REFRESH_MIN_SECONDS = 1  # broker check period after input or a new message
+    REFRESH_MAX_SECONDS = 60  # idle sessions double their period up to this
+    FULL_REFRESH_SECONDS = 300  # catch-all rerun for presence and other unpublished changes
+    CHANGE_FEED_POLL_MS = 10  # how often each worker checks PRAGMA data_version
+    CHANGE_LOG_KEEP = 10000  # change_log rows kept for workers that fall behind
+
+class ConnectionPool:
+    """Process-wide pool of SQLite connections.
+
+    A thread borrows one connection for the duration of a ``with`` block and
+    nested borrows on the same thread reuse it, so helpers that call other
+    helpers stay on a single connection. Helpers commit through commit(),
+    which an enclosing unit_of_work() defers to its own single commit.
+    """
+
+    def __init__(self, path, max_idle=ChatConfig.POOL_SIZE, pragmas=None):
+        self.path = path
+        self.max_idle = max_idle
+        self.pragmas = ChatConfig.PRAGMAS if pragmas is None else pragmas
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+        self.commits = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        with self._lock:
+            self.connections_opened += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            # Re-entrant borrow from a helper called by another helper
+            yield conn
+            return
+        
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        local.conn = conn
+        try:
+            yield conn
+        finally:
+            local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            if self._idle.qsize() < self.max_idle:
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def unit_of_work(self):
+        """Run every helper called inside the block in one transaction"""
+        local = self._local
+        if getattr(local, 'unit', False):
+            # Already inside a unit; the outermost block commits
+            with self.connection() as conn:
+                yield conn
+            return
+        
+        with self.connection() as conn:
+            local.unit = True
+            try:
+                yield conn
+            except BaseException:
+                local.unit = False
+                conn.rollback()
+                raise
+            local.unit = False
+            self.commit(conn)
+
+    @contextmanager
+    def dry_run(self):
+        """Like unit_of_work(), but everything done in the block is rolled back"""
+        local = self._local
+        with self.connection() as conn:
+            local.unit = True
+            try:
+                yield conn
+            finally:
+                local.unit = False
+                conn.rollback()
+
+    def commit(self, conn):
+        if getattr(self._local, 'unit', False):
+            return
+        conn.commit()
+        with self._lock:
+            self.commits += 1
+
+@st.cache_resource
+def get_connection_pool():
+    pool = ConnectionPool(ChatConfig.DB_PATH)
+    with pool.connection() as conn:
+        run_migrations(conn)
+        run_schema_rebuilds(conn)
+    return pool
+
+def db_connection():
+    return get_connection_pool().connection()
+
+def unit_of_work():
+    return get_connection_pool().unit_of_work()
+
+def commit(conn):
+    get_connection_pool().commit(conn)
+
+# Schema migrations (applied once per process, see get_connection_pool)
+def migrate_initial_schema(cursor):
     # Enhanced Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -264,9 +418,646 @@ def init_database():
         cursor.execute('''
             INSERT OR IGNORE INTO rooms (name, description, created_by, category) VALUES (?, ?, ?, ?)
         ''', (room_name, description, created_by, category))
+
+def migrate_hot_query_indexes(cursor):
+    # Room history: room = ? AND target_user IS NULL ORDER BY timestamp
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_time ON messages (room, target_user, timestamp)")
+    # Direct messages: (username, target_user) in both directions
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_dm_time ON messages (username, target_user, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user_time ON notifications (username, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_activity ON user_sessions (last_activity, username)")
+    # friends(user1, user2) is already covered by its UNIQUE constraint
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_friends_user2 ON friends (user2, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_friend_requests_to ON friend_requests (to_user, status, sent_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interactions_pair ON user_interactions (user1, user2)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interactions_pair_rev ON user_interactions (user2, user1)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rooms_public_name ON rooms (is_private, name)")
+
+def migrate_message_id_indexes(cursor):
+    # Delta sync probes id > ? within a room or a DM pair
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, target_user, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_dm_id ON messages (username, target_user, id)")
+
+def add_column(cursor, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN that is a no-op when the column already exists"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate_attachment_metadata(cursor):
+    add_column(cursor, 'messages', 'file_size', 'INTEGER')
+    add_column(cursor, 'messages', 'file_mime', 'TEXT')
+    add_column(cursor, 'messages', 'file_width', 'INTEGER')
+    add_column(cursor, 'messages', 'file_height', 'INTEGER')
     
-    conn.commit()
-    return conn
+    # Backfill one row at a time so large images are never all in memory
+    cursor.execute("SELECT id FROM messages WHERE file_data IS NOT NULL AND file_size IS NULL")
+    for (message_id,) in cursor.fetchall():
+        cursor.execute("SELECT file_data FROM messages WHERE id = ?", (message_id,))
+        metadata = image_metadata(cursor.fetchone()[0])
+        cursor.execute(
+            "UPDATE messages SET file_size = ?, file_mime = ?, file_width = ?, file_height = ? WHERE id = ?",
+            (*metadata, message_id)
+        )
+
+def migrate_attachment_store(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mime TEXT,
+            width INTEGER,
+            height INTEGER,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    add_column(cursor, 'messages', 'attachment_sha', 'TEXT')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_attachment ON messages (attachment_sha) WHERE attachment_sha IS NOT NULL")
+    
+    # Move inline BLOBs into the store one row at a time
+    cursor.execute("SELECT id FROM messages WHERE file_data IS NOT NULL")
+    for (message_id,) in cursor.fetchall():
+        cursor.execute("SELECT file_data, file_size, file_mime, file_width, file_height FROM messages WHERE id = ?", (message_id,))
+        file_data, *metadata = cursor.fetchone()
+        attachment_sha = store_attachment(cursor, file_data, metadata)
+        cursor.execute("UPDATE messages SET attachment_sha = ?, file_data = NULL WHERE id = ?", (attachment_sha, message_id))
+    cursor.execute('''
+        UPDATE attachments SET ref_count = (
+            SELECT COUNT(*) FROM messages WHERE attachment_sha = attachments.sha256
+        )
+    ''')
+    create_attachment_triggers(cursor)
+
+def create_attachment_triggers(cursor):
+    # Keep reference counts in step with messages from here on
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_attachment_ref_insert
+        AFTER INSERT ON messages WHEN NEW.attachment_sha IS NOT NULL
+        BEGIN
+            UPDATE attachments SET ref_count = ref_count + 1 WHERE sha256 = NEW.attachment_sha;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_attachment_ref_delete
+        AFTER DELETE ON messages WHEN OLD.attachment_sha IS NOT NULL
+        BEGIN
+            UPDATE attachments SET ref_count = ref_count - 1 WHERE sha256 = OLD.attachment_sha;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_attachment_ref_update
+        AFTER UPDATE OF attachment_sha ON messages
+        BEGIN
+            UPDATE attachments SET ref_count = ref_count - 1 WHERE sha256 = OLD.attachment_sha;
+            UPDATE attachments SET ref_count = ref_count + 1 WHERE sha256 = NEW.attachment_sha;
+        END
+    ''')
+
+def migrate_session_per_user(cursor):
+    # user_sessions becomes the presence snapshot: one row per user
+    cursor.execute('''
+        DELETE FROM user_sessions WHERE id NOT IN (
+            SELECT MAX(id) FROM user_sessions GROUP BY username
+        )
+    ''')
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_username ON user_sessions (username)")
+
+def migrate_change_log(cursor):
+    # Append-only feed of changed channels, tailed by every worker's ChangeFeed
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migrate_recommendation_index(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_interests (
+            interest TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (interest, username)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_recommendations (
+            username TEXT NOT NULL,
+            candidate TEXT NOT NULL,
+            mutual_friends INTEGER NOT NULL DEFAULT 0,
+            shared_interests INTEGER NOT NULL DEFAULT 0,
+            interaction_strength INTEGER NOT NULL DEFAULT 0,
+            score INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, candidate)
+        ) WITHOUT ROWID
+    ''')
+    # Top-K for a user is one range scan in score order
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_recommendations_rank ON user_recommendations (username, score)")
+    # Cold-start suggestions walk users by popularity
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_views ON users (profile_views)")
+    # Filled from existing friendships once the schema is current
+    cursor.execute("INSERT OR IGNORE INTO schema_rebuilds (name) VALUES ('recommendations')")
+
+def migrate_friend_edges(cursor):
+    # Each friendship stored in both directions, so "friends of X" is one key range
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS friend_edges (
+            username TEXT NOT NULL,
+            friend TEXT NOT NULL,
+            since TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (username, friend)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO friend_edges (username, friend, since)
+        SELECT user1, user2, since FROM friends WHERE status = 'accepted'
+        UNION ALL
+        SELECT user2, user1, since FROM friends WHERE status = 'accepted'
+    ''')
+
+def rebuild_table(cursor, table, create_sql, copy_sql):
+    """Swap a table for a new definition; copy_sql selects its rows from old_<table>.
+
+    Not re-runnable: the copy expects the old shape. Only call it from a
+    migration step, whose transaction makes the swap all or nothing.
+    """
+    cursor.execute(f"ALTER TABLE {table} RENAME TO old_{table}")
+    cursor.execute(create_sql)
+    cursor.execute(f"INSERT INTO {table} {copy_sql}")
+    # Indexes and triggers go with the old table and are recreated by the caller
+    cursor.execute(f"DROP TABLE old_{table}")
+
+def migrate_user_ids(cursor):
+    # Every name referenced anywhere needs a users row to point at, including
+    # the "system" sender of announcements. These rows have no password hash,
+    # so nobody can log in as them.
+    cursor.execute('''
+        INSERT OR IGNORE INTO users (username, password, status)
+        SELECT username, '', 'offline' FROM (
+            SELECT 'system' AS username
+            UNION SELECT username FROM messages UNION SELECT target_user FROM messages
+            UNION SELECT user1 FROM friends UNION SELECT user2 FROM friends
+            UNION SELECT from_user FROM friend_requests UNION SELECT to_user FROM friend_requests
+            UNION SELECT username FROM notifications
+            UNION SELECT user1 FROM user_interactions UNION SELECT user2 FROM user_interactions
+            UNION SELECT username FROM user_sessions
+        ) WHERE username IS NOT NULL
+    ''')
+    
+    # Messages lose file_data too; migration 5 moved every BLOB to the attachment store
+    rebuild_table(cursor, 'messages', '''
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            target_id INTEGER REFERENCES users (id),
+            message_type TEXT DEFAULT 'text',
+            content TEXT NOT NULL,
+            reply_to INTEGER,
+            is_edited BOOLEAN DEFAULT FALSE,
+            is_read BOOLEAN DEFAULT FALSE,
+            reactions TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            file_size INTEGER,
+            file_mime TEXT,
+            file_width INTEGER,
+            file_height INTEGER,
+            attachment_sha TEXT
+        )
+    ''', '''
+        SELECT m.id, m.room, u.id, t.id, m.message_type, m.content, m.reply_to, m.is_edited, m.is_read,
+               m.reactions, m.timestamp, m.file_size, m.file_mime, m.file_width, m.file_height, m.attachment_sha
+        FROM old_messages m
+        JOIN users u ON u.username = m.username
+        LEFT JOIN users t ON t.username = m.target_user
+    ''')
+    rebuild_table(cursor, 'friends', '''
+        CREATE TABLE friends (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER NOT NULL REFERENCES users (id),
+            user2_id INTEGER NOT NULL REFERENCES users (id),
+            status TEXT DEFAULT 'pending',
+            since TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user1_id, user2_id)
+        )
+    ''', '''
+        SELECT f.id, u1.id, u2.id, f.status, f.since
+        FROM old_friends f
+        JOIN users u1 ON u1.username = f.user1
+        JOIN users u2 ON u2.username = f.user2
+    ''')
+    rebuild_table(cursor, 'friend_requests', '''
+        CREATE TABLE friend_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_id INTEGER NOT NULL REFERENCES users (id),
+            to_id INTEGER NOT NULL REFERENCES users (id),
+            status TEXT DEFAULT 'pending',
+            message TEXT DEFAULT '',
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''', '''
+        SELECT r.id, f.id, t.id, r.status, r.message, r.sent_at
+        FROM old_friend_requests r
+        JOIN users f ON f.username = r.from_user
+        JOIN users t ON t.username = r.to_user
+    ''')
+    rebuild_table(cursor, 'notifications', '''
+        CREATE TABLE notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            type TEXT NOT NULL,
+            content TEXT NOT NULL,
+            is_read BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''', '''
+        SELECT n.id, u.id, n.type, n.content, n.is_read, n.created_at
+        FROM old_notifications n JOIN users u ON u.username = n.username
+    ''')
+    rebuild_table(cursor, 'user_interactions', '''
+        CREATE TABLE user_interactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER NOT NULL REFERENCES users (id),
+            user2_id INTEGER NOT NULL REFERENCES users (id),
+            interaction_type TEXT NOT NULL,
+            strength INTEGER DEFAULT 1,
+            last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''', '''
+        SELECT i.id, MIN(u1.id, u2.id), MAX(u1.id, u2.id), i.interaction_type, i.strength, i.last_interaction
+        FROM old_user_interactions i
+        JOIN users u1 ON u1.username = i.user1
+        JOIN users u2 ON u2.username = i.user2
+    ''')
+    # One presence row per user, so the user id is the key
+    rebuild_table(cursor, 'user_sessions', '''
+        CREATE TABLE user_sessions (
+            user_id INTEGER PRIMARY KEY REFERENCES users (id),
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            room TEXT DEFAULT 'general'
+        )
+    ''', '''
+        SELECT u.id, s.last_activity, s.room
+        FROM old_user_sessions s JOIN users u ON u.username = s.username
+    ''')
+    rebuild_table(cursor, 'friend_edges', '''
+        CREATE TABLE friend_edges (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            friend_id INTEGER NOT NULL REFERENCES users (id),
+            since TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, friend_id)
+        ) WITHOUT ROWID
+    ''', '''
+        SELECT u.id, f.id, e.since
+        FROM old_friend_edges e
+        JOIN users u ON u.username = e.username
+        JOIN users f ON f.username = e.friend
+    ''')
+    
+    # Same indexes as before, on the id columns
+    cursor.execute("CREATE INDEX idx_messages_room_time ON messages (room, target_id, timestamp)")
+    cursor.execute("CREATE INDEX idx_messages_dm_time ON messages (user_id, target_id, timestamp)")
+    cursor.execute("CREATE INDEX idx_messages_room_id ON messages (room, target_id, id)")
+    cursor.execute("CREATE INDEX idx_messages_dm_id ON messages (user_id, target_id, id)")
+    cursor.execute("CREATE INDEX idx_messages_attachment ON messages (attachment_sha) WHERE attachment_sha IS NOT NULL")
+    cursor.execute("CREATE INDEX idx_friends_user2 ON friends (user2_id, status)")
+    cursor.execute("CREATE INDEX idx_friend_requests_to ON friend_requests (to_id, status, sent_at)")
+    cursor.execute("CREATE INDEX idx_notifications_user_time ON notifications (user_id, created_at)")
+    cursor.execute("CREATE INDEX idx_interactions_pair ON user_interactions (user1_id, user2_id)")
+    cursor.execute("CREATE INDEX idx_interactions_pair_rev ON user_interactions (user2_id, user1_id)")
+    cursor.execute("CREATE INDEX idx_sessions_activity ON user_sessions (last_activity, user_id)")
+    create_attachment_triggers(cursor)
+    
+    # The recommendation index is derived data, so it is recreated rather than copied
+    cursor.execute("DROP TABLE user_recommendations")
+    cursor.execute("DROP TABLE user_interests")
+    cursor.execute('''
+        CREATE TABLE user_interests (
+            interest TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            PRIMARY KEY (interest, user_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE user_recommendations (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            candidate_id INTEGER NOT NULL REFERENCES users (id),
+            mutual_friends INTEGER NOT NULL DEFAULT 0,
+            shared_interests INTEGER NOT NULL DEFAULT 0,
+            interaction_strength INTEGER NOT NULL DEFAULT 0,
+            score INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, candidate_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX idx_recommendations_rank ON user_recommendations (user_id, score)")
+    cursor.execute("INSERT OR IGNORE INTO schema_rebuilds (name) VALUES ('recommendations')")
+
+# Current time in epoch milliseconds, as a column default
+EPOCH_MS_NOW = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+def migrate_epoch_timestamps(cursor):
+    # Integer epoch milliseconds instead of 19 character CURRENT_TIMESTAMP text.
+    # Ordering uses the id, so the timestamp no longer needs to be indexed.
+    rebuild_table(cursor, 'messages', f'''
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            target_id INTEGER REFERENCES users (id),
+            message_type TEXT DEFAULT 'text',
+            content TEXT NOT NULL,
+            reply_to INTEGER,
+            is_edited BOOLEAN DEFAULT FALSE,
+            is_read BOOLEAN DEFAULT FALSE,
+            reactions TEXT,
+            timestamp INTEGER NOT NULL DEFAULT ({EPOCH_MS_NOW}),
+            file_size INTEGER,
+            file_mime TEXT,
+            file_width INTEGER,
+            file_height INTEGER,
+            attachment_sha TEXT
+        )
+    ''', '''
+        SELECT id, room, user_id, target_id, message_type, content, reply_to, is_edited, is_read, reactions,
+               COALESCE(CAST(strftime('%s', timestamp) AS INTEGER) * 1000, 0),
+               file_size, file_mime, file_width, file_height, attachment_sha
+        FROM old_messages
+    ''')
+    rebuild_table(cursor, 'notifications', f'''
+        CREATE TABLE notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            type TEXT NOT NULL,
+            content TEXT NOT NULL,
+            is_read BOOLEAN DEFAULT FALSE,
+            created_at INTEGER NOT NULL DEFAULT ({EPOCH_MS_NOW})
+        )
+    ''', '''
+        SELECT id, user_id, type, content, is_read, COALESCE(CAST(strftime('%s', created_at) AS INTEGER) * 1000, 0)
+        FROM old_notifications
+    ''')
+    
+    cursor.execute("CREATE INDEX idx_messages_room_id ON messages (room, target_id, id)")
+    cursor.execute("CREATE INDEX idx_messages_dm_id ON messages (user_id, target_id, id)")
+    cursor.execute("CREATE INDEX idx_messages_attachment ON messages (attachment_sha) WHERE attachment_sha IS NOT NULL")
+    # The rowid is the last key of every index, so this also serves ORDER BY id
+    cursor.execute("CREATE INDEX idx_notifications_user ON notifications (user_id)")
+    create_attachment_triggers(cursor)
+
+def migrate_read_cursors(cursor):
+    # Per reader and conversation: how far they have read and how many newer
+    # items are waiting, so every badge comes from one key range
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            conversation TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conversation)
+        ) WITHOUT ROWID
+    ''')
+    # A room message bumps every reader of that room
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_read_cursors_conversation ON read_cursors (conversation)")
+    
+    # notifications.is_read was maintained, so each feed cursor starts at the
+    # newest read notification and its badge counts only the rows past it,
+    # exactly what get_notifications shows as unread. messages.is_read never
+    # was, so room and DM cursors start when a conversation is next opened
+    # or messaged.
+    cursor.execute('''
+        INSERT OR IGNORE INTO read_cursors (user_id, conversation, last_read_id, unread)
+        SELECT user_id, 'notifications', last_read_id,
+               (SELECT COUNT(*) FROM notifications n WHERE n.user_id = feed.user_id AND n.id > feed.last_read_id)
+        FROM (
+            SELECT user_id, COALESCE(MAX(CASE WHEN is_read THEN id END), 0) AS last_read_id
+            FROM notifications GROUP BY user_id
+        ) feed
+    ''')
+
+def migrate_conversations(cursor):
+    # One row per DM pair, written on every direct message, so the DM list and
+    # its previews are an index range instead of a messages scan per friend.
+    # Each side's read cursor and unread counter live on the row, replacing
+    # the "dm:<peer>" rows in read_cursors.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_low INTEGER NOT NULL REFERENCES users (id),
+            user_high INTEGER NOT NULL REFERENCES users (id),
+            last_message_id INTEGER NOT NULL,
+            last_message_at INTEGER NOT NULL,
+            low_read_id INTEGER NOT NULL DEFAULT 0,
+            high_read_id INTEGER NOT NULL DEFAULT 0,
+            low_unread INTEGER NOT NULL DEFAULT 0,
+            high_unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_low, user_high)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_low_recent ON conversations (user_low, last_message_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_high_recent ON conversations (user_high, last_message_id)")
+    
+    # With MAX() as the only aggregate SQLite takes the bare timestamp from
+    # the same row, i.e. the time of the newest message of each pair
+    cursor.execute('''
+        INSERT OR IGNORE INTO conversations (user_low, user_high, last_message_id, last_message_at)
+        SELECT MIN(user_id, target_id), MAX(user_id, target_id), MAX(id), timestamp
+        FROM messages WHERE target_id IS NOT NULL
+        GROUP BY MIN(user_id, target_id), MAX(user_id, target_id)
+    ''')
+    for side, reader, peer in (('low', 'user_low', 'user_high'), ('high', 'user_high', 'user_low')):
+        cursor.execute(f'''
+            UPDATE conversations SET ({side}_read_id, {side}_unread) = (
+                SELECT last_read_id, unread FROM read_cursors
+                WHERE user_id = conversations.{reader} AND conversation = 'dm:' || conversations.{peer}
+            )
+            WHERE EXISTS (
+                SELECT 1 FROM read_cursors
+                WHERE user_id = conversations.{reader} AND conversation = 'dm:' || conversations.{peer}
+            )
+        ''')
+    cursor.execute("DELETE FROM read_cursors WHERE conversation LIKE 'dm:%'")
+
+def migrate_room_counters(cursor):
+    # One message counter per room, bumped once per send. A room cursor keeps
+    # the counter value it has accounted for (read_count), so unread is the
+    # difference and a send no longer updates every reader's cursor.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_counters (
+            conversation TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO message_counters (conversation, message_count)
+        SELECT 'room:' || room, COUNT(*) FROM messages WHERE target_id IS NULL GROUP BY room
+    ''')
+    if 'read_count' not in {row[1] for row in cursor.execute("PRAGMA table_info(read_cursors)")}:
+        cursor.execute("ALTER TABLE read_cursors ADD COLUMN read_count INTEGER NOT NULL DEFAULT 0")
+        # Carry the current room badges over as counter differences
+        cursor.execute('''
+            UPDATE read_cursors SET
+                read_count = COALESCE((
+                    SELECT message_count FROM message_counters c WHERE c.conversation = read_cursors.conversation
+                ), 0) - unread,
+                unread = 0
+            WHERE conversation LIKE 'room:%'
+        ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_read_cursors_conversation")
+
+# Ordered (version, description, step) list. Steps must not commit: each one
+# runs in the transaction that records its version, so it is applied exactly
+# once and a failure leaves no trace. Steps that only add tables, columns or
+# indexes also guard them (IF NOT EXISTS) so they tolerate a hand-made copy.
+# Steps that rebuild a table (rebuild_table) convert rows in place and cannot
+# run twice; they rely on the transaction alone.
+MIGRATIONS = [
+    (1, 'initial schema and default rooms', migrate_initial_schema),
+    (2, 'indexes for chat, friend and notification queries', migrate_hot_query_indexes),
+    (3, 'indexes for incremental message sync', migrate_message_id_indexes),
+    (4, 'attachment metadata columns on messages', migrate_attachment_metadata),
+    (5, 'move message BLOBs to the attachment store', migrate_attachment_store),
+    (6, 'one presence snapshot row per user', migrate_session_per_user),
+    (7, 'change log shared by all workers', migrate_change_log),
+    (8, 'precomputed friend recommendations', migrate_recommendation_index),
+    (9, 'symmetric friendship adjacency', migrate_friend_edges),
+    (10, 'integer user ids as foreign keys', migrate_user_ids),
+    (11, 'epoch millisecond message and notification times', migrate_epoch_timestamps),
+    (12, 'read cursors and unread counters', migrate_read_cursors),
+    (13, 'direct message conversation index', migrate_conversations),
+    (14, 'per-room message counters for unread badges', migrate_room_counters),
+]
+
+def get_schema_version(cursor):
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def run_migrations(conn, target_version=None):
+    """Bring the database up to target_version (latest by default).
+
+    Returns (version, description, duration_ms) for every step applied, so an
+    empty list means the schema was already current.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            duration_ms REAL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Derived data a step has emptied or reshaped, see run_schema_rebuilds
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_rebuilds (name TEXT PRIMARY KEY)")
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if target_version is not None and version > target_version:
+            break
+
+        # IMMEDIATE takes the write lock up front so workers starting
+        # together apply each step exactly once
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(cursor) >= version:
+                conn.rollback()
+                continue
+            started = time.perf_counter()
+            migrate(cursor)
+            duration_ms = (time.perf_counter() - started) * 1000
+            cursor.execute(
+                "INSERT INTO schema_version (version, description, duration_ms) VALUES (?, ?, ?)",
+                (version, description, duration_ms)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((version, description, duration_ms))
+
+    return applied
+
+def run_schema_rebuilds(conn):
+    """Rebuild the derived data that migration steps flagged in schema_rebuilds.
+
+    Steps only record the flag: the rebuild runs application code, which
+    expects the latest schema, so it waits until every step is applied.
+    Returns (name, duration_ms) for each rebuild run.
+    """
+    cursor = conn.cursor()
+    if get_schema_version(cursor) < MIGRATIONS[-1][0]:
+        return []
+    cursor.execute("SELECT 1 FROM schema_rebuilds LIMIT 1")
+    if cursor.fetchone() is None:
+        return []
+    
+    rebuilds = {'recommendations': rebuild_recommendations}
+    done = []
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SELECT name FROM schema_rebuilds")
+        for (name,) in cursor.fetchall():
+            started = time.perf_counter()
+            rebuilds[name](cursor)
+            cursor.execute("DELETE FROM schema_rebuilds WHERE name = ?", (name,))
+            done.append((name, (time.perf_counter() - started) * 1000))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return done
+
+class UserDirectory:
+    """In-process username <-> user id map for one database.
+
+    Tables refer to users by integer id; helpers still speak usernames and
+    translate at the edges. Usernames never change and users are never
+    deleted, so an entry is read from users once and then served from memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._names = {}
+
+    def remember(self, user_id, username):
+        with self._lock:
+            self._ids[username] = user_id
+            self._names[user_id] = username
+
+    def id_for(self, username):
+        """Id of a user, or None when there is no such user"""
+        user_id = self._ids.get(username)
+        if user_id is None and username is not None:
+            with db_connection() as conn:
+                row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            user_id = row[0]
+            self.remember(user_id, username)
+        return user_id
+
+    def name_for(self, user_id):
+        username = self._names.get(user_id)
+        if username is None and user_id is not None:
+            with db_connection() as conn:
+                row = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            username = row[0]
+            self.remember(user_id, username)
+        return username
+
+@st.cache_resource
+def user_directory_for(db_path):
+    return UserDirectory()
+
+def get_user_directory():
+    # Keyed by path: ids from one database mean nothing in another
+    return user_directory_for(ChatConfig.DB_PATH)
+
+def get_user_id(username):
+    return get_user_directory().id_for(username)
 
 def hash_password(password):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -275,318 +1066,1573 @@ def verify_password(password, hashed):
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
 def register_user(username, password, email=None, bio="", interests="", location=""):
-    conn = init_database()
-    cursor = conn.cursor()
-    try:
-        avatars = ['👤', '👨', '👩', '🧑', '👨‍💼', '👩‍💼', '👨‍🎓', '👩‍🎓', '🦸', '🦸‍♀️', '🧙', '🧙‍♀️', '👨‍🚀', '👩‍🚀']
-        avatar = random.choice(avatars)
-        
-        cursor.execute(
-            "INSERT INTO users (username, password, email, avatar, bio, interests, location) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (username, hash_password(password), email, avatar, bio, interests, location)
-        )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            avatars = ['👤', '👨', '👩', '🧑', '👨‍💼', '👩‍💼', '👨‍🎓', '👩‍🎓', '🦸', '🦸‍♀️', '🧙', '🧙‍♀️', '👨‍🚀', '👩‍🚀']
+            avatar = random.choice(avatars)
+            
+            cursor.execute(
+                "INSERT INTO users (username, password, email, avatar, bio, interests, location) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (username, hash_password(password), email, avatar, bio, interests, location)
+            )
+            new_id = cursor.lastrowid
+            index_interests(cursor, new_id, '', interests)
+            commit(conn)
+            get_user_directory().remember(new_id, username)
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 def authenticate_user(username, password):
-    conn = init_database()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT password FROM users WHERE username = ?",
-        (username,)
-    )
-    result = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT password FROM users WHERE username = ?",
+            (username,)
+        )
+        result = cursor.fetchone()
     
-    if result and verify_password(password, result[0]):
+    # Accounts created by the user id migration have no password hash
+    if result and result[0] and verify_password(password, result[0]):
         update_user_session(username)
         return True
     return False
 
-def update_user_session(username, room='general'):
-    conn = init_database()
-    cursor = conn.cursor()
-    session_id = f"{username}_{int(time.time())}"
+class PresenceRegistry:
+    """In-process map of online users: username -> (room, last heartbeat).
+
+    Entries are kept in heartbeat order, so a heartbeat is O(1) and expiry
+    only ever looks at the stalest entries. A room -> users index is kept in
+    step with every change, so listing a room costs the size of the room.
+    A background thread snapshots the map into user_sessions and merges in
+    users seen by other workers.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # username -> {'room', 'heartbeat', 'card'}
+        self._rooms = {}  # room -> set of usernames
+        self._dirty = set()
+        self._departed = set()  # logged out since the last snapshot
+
+    def _move(self, username, old_room, new_room):
+        if old_room == new_room:
+            return
+        if old_room is not None:
+            members = self._rooms.get(old_room)
+            if members is not None:
+                members.discard(username)
+                if not members:
+                    del self._rooms[old_room]
+        if new_room is not None:
+            self._rooms.setdefault(new_room, set()).add(username)
+
+    def _remove(self, username):
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            self._move(username, entry['room'], None)
+        self._dirty.discard(username)
+
+    def heartbeat(self, username, room=None, at=None):
+        """Mark a user active; room=None keeps them in their current room"""
+        at = time.time() if at is None else at
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                room = room or 'general'
+                entry = self._entries[username] = {'room': None, 'heartbeat': at, 'card': None}
+            else:
+                room = room or entry['room']
+                entry['heartbeat'] = at
+                self._entries.move_to_end(username)
+            self._move(username, entry['room'], room)
+            entry['room'] = room
+            self._dirty.add(username)
+            self._departed.discard(username)
+
+    def leave(self, username):
+        """Log a user out here; the next snapshot removes them for every worker"""
+        with self._lock:
+            self._remove(username)
+            self._departed.add(username)
+
+    def expire(self, now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        with self._lock:
+            while self._entries:
+                username, entry = next(iter(self._entries.items()))
+                if entry['heartbeat'] > cutoff:
+                    break
+                self._remove(username)
+
+    def online(self, room=None):
+        """(username, room, card) for everyone seen within the TTL, optionally in one room"""
+        self.expire()
+        # Heartbeats merged from other workers may arrive out of order, so
+        # entries behind a fresh one are filtered here rather than expired
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            usernames = self._entries if room is None else self._rooms.get(room, ())
+            return [
+                (username, self._entries[username]['room'], self._entries[username]['card'])
+                for username in usernames if self._entries[username]['heartbeat'] > cutoff
+            ]
+
+    def set_card(self, username, card):
+        with self._lock:
+            if username in self._entries:
+                self._entries[username]['card'] = card
+
+    def forget_card(self, username):
+        self.set_card(username, None)
+
+    def take_dirty(self):
+        with self._lock:
+            dirty = [(username, self._entries[username]['room'], self._entries[username]['heartbeat']) for username in self._dirty]
+            self._dirty.clear()
+            return dirty
+
+    def take_departed(self):
+        with self._lock:
+            departed = list(self._departed)
+            self._departed.clear()
+            return departed
+
+    def merge(self, username, room, heartbeat):
+        """Adopt a heartbeat recorded by another worker if it is newer than ours"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry['heartbeat'] >= heartbeat:
+                return
+        if heartbeat > time.time() - self.ttl:
+            self.heartbeat(username, room, at=heartbeat)
+            with self._lock:
+                self._dirty.discard(username)
+
+def persist_presence(registry):
+    """Write heartbeats since the last snapshot and pull in other workers' users"""
+    directory = get_user_directory()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Heartbeats for names without an account have no row to point at
+        dirty = [
+            (directory.id_for(username), room, heartbeat)
+            for username, room, heartbeat in registry.take_dirty()
+        ]
+        dirty = [entry for entry in dirty if entry[0] is not None]
+        if dirty:
+            cursor.executemany('''
+                INSERT INTO user_sessions (user_id, last_activity, room)
+                VALUES (?, datetime(?, 'unixepoch'), ?)
+                ON CONFLICT(user_id) DO UPDATE SET last_activity = excluded.last_activity, room = excluded.room
+            ''', [(user_id, heartbeat, room) for user_id, room, heartbeat in dirty])
+            cursor.executemany('''
+                UPDATE users SET status = 'online', last_seen = datetime(?, 'unixepoch')
+                WHERE id = ?
+            ''', [(heartbeat, user_id) for user_id, room, heartbeat in dirty])
+        # Without their snapshot row, the merge below and other workers
+        # cannot bring a logged out user back
+        departed = [(user_id,) for user_id in map(directory.id_for, registry.take_departed()) if user_id is not None]
+        if departed:
+            cursor.executemany("DELETE FROM user_sessions WHERE user_id = ?", departed)
+            cursor.executemany("UPDATE users SET status = 'offline' WHERE id = ?", departed)
+        if dirty or departed:
+            commit(conn)
+        
+        cursor.execute('''
+            SELECT u.username, s.room, CAST(strftime('%s', s.last_activity) AS INTEGER)
+            FROM user_sessions s JOIN users u ON u.id = s.user_id
+            WHERE s.last_activity > datetime('now', ?)
+        ''', (f"-{registry.ttl} seconds",))
+        for username, room, heartbeat in cursor.fetchall():
+            registry.merge(username, room, heartbeat)
+
+@st.cache_resource
+def get_presence_registry():
+    registry = PresenceRegistry(ChatConfig.PRESENCE_TTL_SECONDS)
     
-    cursor.execute('''
-        INSERT OR REPLACE INTO user_sessions (username, session_id, last_activity, room)
-        VALUES (?, ?, CURRENT_TIMESTAMP, ?)
-    ''', (username, session_id, room))
+    def snapshot_loop():
+        while True:
+            try:
+                persist_presence(registry)
+            except sqlite3.Error:
+                pass  # retried on the next tick
+            time.sleep(ChatConfig.PRESENCE_SNAPSHOT_SECONDS)
     
-    cursor.execute('''
-        UPDATE users SET status = 'online', last_seen = CURRENT_TIMESTAMP 
-        WHERE username = ?
-    ''', (username,))
+    # The first snapshot also restores users who were online before a restart
+    threading.Thread(target=snapshot_loop, name="presence-snapshot", daemon=True).start()
+    return registry
+
+def update_user_session(username, room='general'):
+    get_presence_registry().heartbeat(username, room)
+
+
+def image_metadata(file_data):
+    """(size, mime, width, height) of an uploaded file; dimensions are None when PIL cannot read it"""
+    try:
+        # Image.open only parses the header, the pixels are never decoded here
+        with Image.open(io.BytesIO(file_data)) as image:
+            return len(file_data), Image.MIME.get(image.format, 'application/octet-stream'), image.width, image.height
+    except Exception:
+        return len(file_data), 'application/octet-stream', None, None
+
+class AttachmentStore:
+    """Content-addressed attachment files under ChatConfig.ATTACHMENT_DIR.
+
+    Files are named by the SHA-256 of their bytes, so an image posted in many
+    rooms is stored once. Reference counts live in the attachments table and
+    are maintained by triggers on messages.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def put(self, data, replace=False):
+        """Store bytes under their SHA-256; replace=True rewrites an existing file"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256)
+        if replace or not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return sha256
+
+    @contextmanager
+    def open(self, sha256):
+        """Read-only memory map of an attachment, shared through the page cache.
+
+        The map is a seekable file object, so decoders read it in place, and
+        it is unmapped when the block exits.
+        """
+        with open(self.path_for(sha256), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield io.BytesIO(b'')  # an empty file cannot be mapped
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def thumbnail_path(self, sha256, size):
+        return os.path.join(self.root, 'thumbs', str(size), sha256[:2], f"{sha256}.{ChatConfig.THUMBNAIL_FORMAT.lower()}")
+
+    def remove(self, sha256):
+        # Every size on disk, including ones no longer configured
+        thumbs = os.path.join(self.root, 'thumbs')
+        sizes = os.listdir(thumbs) if os.path.isdir(thumbs) else []
+        for path in [self.path_for(sha256)] + [self.thumbnail_path(sha256, size) for size in sizes]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+@st.cache_resource
+def get_attachment_store():
+    # Relative paths live next to the database so --db moves both together
+    root = os.path.join(os.path.dirname(os.path.abspath(ChatConfig.DB_PATH)), ChatConfig.ATTACHMENT_DIR)
+    return AttachmentStore(root)
+
+class ByteLRUCache:
+    """Thread-safe LRU bounded by the total size of its values in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous)
+            self._items[key] = value
+            self.current_bytes += len(value)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+@st.cache_resource
+def get_thumbnail_cache():
+    return ByteLRUCache(ChatConfig.THUMBNAIL_CACHE_BYTES)
+
+class ThumbnailPipeline:
+    """Worker pool that renders thumbnails off the request path, once per attachment"""
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.failed = set()
+
+    def schedule(self, sha256):
+        with self._lock:
+            if sha256 in self._pending or sha256 in self.failed:
+                return
+            self._pending.add(sha256)
+        self._executor.submit(self._run, sha256)
+
+    def _run(self, sha256):
+        try:
+            generate_thumbnails(sha256)
+        except Exception:
+            with self._lock:
+                self.failed.add(sha256)
+        finally:
+            with self._lock:
+                self._pending.discard(sha256)
+
+@st.cache_resource
+def get_thumbnail_pipeline():
+    return ThumbnailPipeline(ChatConfig.THUMBNAIL_WORKERS)
+
+def generate_thumbnails(sha256):
+    """Decode an attachment once and write every configured thumbnail size"""
+    store = get_attachment_store()
+    pending = [size for size in ChatConfig.THUMBNAIL_SIZES if not os.path.exists(store.thumbnail_path(sha256, size))]
+    if not pending:
+        return
     
-    conn.commit()
-    conn.close()
+    with store.open(sha256) as data, Image.open(data) as image:
+        image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+        for size in sorted(pending, reverse=True):
+            image.thumbnail((size, size))
+            path = store.thumbnail_path(sha256, size)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            image.save(tmp_path, format=ChatConfig.THUMBNAIL_FORMAT, quality=ChatConfig.THUMBNAIL_QUALITY)
+            os.replace(tmp_path, path)
 
-def save_message(room, username, message_type, content, file_data=None, reply_to=None, target_user=None):
-    conn = init_database()
-    cursor = conn.cursor()
+def get_thumbnail(sha256, size):
+    """Encoded thumbnail bytes, or None while the worker pool is still producing them"""
+    cache = get_thumbnail_cache()
+    key = (sha256, size)
+    thumbnail = cache.get(key)
+    if thumbnail is None:
+        try:
+            with open(get_attachment_store().thumbnail_path(sha256, size), 'rb') as f:
+                thumbnail = f.read()
+        except FileNotFoundError:
+            # Uploaded before thumbnails existed, or generation still running
+            get_thumbnail_pipeline().schedule(sha256)
+            return None
+        cache.put(key, thumbnail)
+    return thumbnail
+
+def store_attachment(cursor, file_data, metadata):
+    """Save bytes to the attachment store and register them; returns the SHA-256 key"""
+    sha256 = hashlib.sha256(file_data).hexdigest()
+    size, mime, width, height = metadata
     cursor.execute(
-        "INSERT INTO messages (room, username, message_type, content, file_data, reply_to, target_user) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (room, username, message_type, content, file_data, reply_to, target_user)
+        "INSERT OR IGNORE INTO attachments (sha256, size, mime, width, height) VALUES (?, ?, ?, ?, ?)",
+        (sha256, size, mime, width, height)
     )
-    message_id = cursor.lastrowid
+    # A new row may follow a garbage collection that unlinked the same file
+    # after this upload last looked, so the file is always written again
+    get_attachment_store().put(file_data, replace=cursor.rowcount == 1)
+    return sha256
+
+class MessageBroker:
+    """In-process publish/subscribe of change signals per channel.
+
+    A channel is a room, a DM pair or a user's notification feed. Each
+    publish bumps the channel's version, and a session reruns only when a
+    version it rendered has moved on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def publish(self, channel):
+        with self._lock:
+            self._versions[channel] = self._versions.get(channel, 0) + 1
+
+    def versions(self, channels):
+        with self._lock:
+            return {channel: self._versions.get(channel, 0) for channel in channels}
+
+@st.cache_resource
+def get_message_broker():
+    return MessageBroker()
+
+def room_channel(room):
+    return f"room:{room}"
+
+def dm_channel(user1, user2):
+    return "dm:" + "|".join(sorted([user1, user2]))
+
+def user_channel(username):
+    return f"user:{username}"
+
+def message_channels(room, username, target_user):
+    """Channels a new message changes; a DM also moves the recipient's unread badge"""
+    if target_user:
+        return [dm_channel(username, target_user), user_channel(target_user)]
+    return [room_channel(room)]
+
+def log_change(cursor, channel):
+    """Append a change row in the caller's transaction so every worker sees it"""
+    cursor.execute(
+        "INSERT INTO change_log (channel, origin) VALUES (?, ?)",
+        (channel, get_change_feed().origin)
+    )
+
+def read_changes(after_seq, limit=1000):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT seq, channel, origin FROM change_log
+            WHERE seq > ? ORDER BY seq LIMIT ?
+        ''', (after_seq, limit))
+        return cursor.fetchall()
+
+def prune_change_log(keep):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?", (keep,))
+        commit(conn)
+
+class ChangeFeed:
+    """Relays other workers' commits from change_log into this process's broker.
+
+    The tail thread keeps one pooled connection and polls PRAGMA data_version,
+    which only moves when some other connection commits, so an idle database
+    costs no table reads. When it moves, rows past the last seen seq are read
+    and every channel written by another origin is published locally.
+    """
+
+    def __init__(self, broker, interval):
+        self.broker = broker
+        self.interval = interval
+        self.origin = uuid.uuid4().hex
+        self.last_seq = None
+        self.pruned_seq = 0
+        self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        with db_connection() as conn:
+            data_version = None
+            while True:
+                try:
+                    version = conn.execute("PRAGMA data_version").fetchone()[0]
+                    if version != data_version:
+                        data_version = version
+                        self.poll()
+                except sqlite3.Error:
+                    data_version = None  # retried on the next tick
+                time.sleep(self.interval)
+
+    def poll(self):
+        if self.last_seq is None:
+            # Start at the tail; earlier changes were rendered before this worker existed
+            with db_connection() as conn:
+                self.last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+            self.pruned_seq = self.last_seq
+            return
+        
+        changes = read_changes(self.last_seq)
+        while changes:
+            for seq, channel, origin in changes:
+                if origin != self.origin:
+                    self.broker.publish(channel)
+                    if channel.startswith("user:"):
+                        # A friendship may have changed in another worker
+                        get_friend_cache().invalidate(channel[len("user:"):])
+                self.last_seq = seq
+            changes = read_changes(self.last_seq)
+        
+        # Any worker may trim the log; a worker that falls further behind
+        # than this catches up on its sessions' periodic full refresh
+        if self.last_seq - self.pruned_seq >= ChatConfig.CHANGE_LOG_KEEP:
+            prune_change_log(ChatConfig.CHANGE_LOG_KEEP)
+            self.pruned_seq = self.last_seq
+
+@st.cache_resource
+def get_change_feed():
+    return ChangeFeed(get_message_broker(), ChatConfig.CHANGE_FEED_POLL_MS / 1000)
+
+def insert_message(cursor, room, username, message_type, content, file_data=None, reply_to=None, target_user=None):
+    """INSERT one message row, storing any attachment first; the caller commits"""
+    file_size, file_mime, file_width, file_height = image_metadata(file_data) if file_data else (None, None, None, None)
+    attachment_sha = None
+    if file_data:
+        attachment_sha = store_attachment(cursor, file_data, (file_size, file_mime, file_width, file_height))
+        # Thumbnails only need the stored file, not the committed row
+        get_thumbnail_pipeline().schedule(attachment_sha)
     
-    # Record interaction if it's a direct message
+    directory = get_user_directory()
+    user_id, target_id = directory.id_for(username), directory.id_for(target_user)
+    cursor.execute(
+        """INSERT INTO messages (room, user_id, message_type, content, attachment_sha, file_size, file_mime, file_width, file_height, reply_to, target_id)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (room, user_id, message_type, content, attachment_sha, file_size, file_mime, file_width, file_height, reply_to, target_id)
+    )
+    message_id = cursor.lastrowid
+    if target_user:
+        touch_conversation(cursor, user_id, target_id, message_id)
+    else:
+        bump_room_counter(cursor, room, user_id)
+    for channel in message_channels(room, username, target_user):
+        log_change(cursor, channel)
+    return message_id
+
+class MessageWriter:
+    """Write-behind queue drained by one thread that group-commits messages.
+
+    A batch is everything queued when the writer is ready, up to
+    ChatConfig.WRITE_BATCH_SIZE messages, and is committed straight away:
+    messages sent while one batch commits share the next fsync, and a lone
+    message never waits for company. Each caller gets a Future that
+    resolves to its message id once the batch is durable.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.batches_committed = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as error:
+                # No connection, or a failure outside the batch transaction:
+                # fail whatever is still pending and keep the writer alive
+                for future, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _write(self, batch):
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                message_ids = [write_behind_message(cursor, *args, **kwargs) for _, args, kwargs in batch]
+                commit(conn)
+            except Exception:
+                conn.rollback()
+                # Retry one by one so a single bad message cannot fail its neighbours
+                for future, args, kwargs in batch:
+                    try:
+                        message_id = write_behind_message(cursor, *args, **kwargs)
+                        commit(conn)
+                    except Exception as error:
+                        conn.rollback()
+                        future.set_exception(error)
+                        continue
+                    future.set_result(message_id)
+                    publish_message(*args, **kwargs)
+                return
+        
+        self.batches_committed += 1
+        # Messages are durable now; resolve every sender before publishing so
+        # a failed publish cannot leave a committed message's future pending
+        for (future, args, kwargs), message_id in zip(batch, message_ids):
+            future.set_result(message_id)
+        for future, args, kwargs in batch:
+            publish_message(*args, **kwargs)
+
+def write_behind_message(cursor, room, username, message_type, content, file_data=None, reply_to=None, target_user=None):
+    """Everything save_message does, inside the writer's batch transaction"""
+    message_id = insert_message(cursor, room, username, message_type, content, file_data, reply_to, target_user)
     if target_user:
-        record_interaction(username, target_user, 'message')
+        insert_interaction(cursor, username, target_user, 'message')
+    # Direct messages keep the sender in the room they are viewing
+    update_user_session(username, None if target_user else room)
+    return message_id
+
+def publish_message(room, username, message_type, content, file_data=None, reply_to=None, target_user=None):
+    """Wake sessions watching the conversation a committed message belongs to"""
+    broker = get_message_broker()
+    for channel in message_channels(room, username, target_user):
+        broker.publish(channel)
+
+@st.cache_resource
+def get_message_writer():
+    return MessageWriter(ChatConfig.WRITE_BATCH_SIZE)
+
+def queue_message(room, username, message_type, content, file_data=None, reply_to=None, target_user=None):
+    """Hand a message to the write-behind queue; returns a Future for its id"""
+    return get_message_writer().submit(room, username, message_type, content, file_data, reply_to, target_user)
+
+def save_message(room, username, message_type, content, file_data=None, reply_to=None, target_user=None):
+    if ChatConfig.WRITE_BEHIND:
+        return queue_message(room, username, message_type, content, file_data, reply_to, target_user).result()
     
-    conn.commit()
-    conn.close()
-    update_user_session(username, room)
+    # The message, its change_log row and the interaction bump commit together
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
+        message_id = insert_message(cursor, room, username, message_type, content, file_data, reply_to, target_user)
+        
+        # Record interaction if it's a direct message
+        if target_user:
+            record_interaction(username, target_user, 'message')
+    publish_message(room, username, message_type, content, target_user=target_user)
+    # Direct messages keep the sender in the room they are viewing
+    update_user_session(username, None if target_user else room)
     return message_id
 
-def get_message_history(room, limit=100, target_user=None):
-    conn = init_database()
-    cursor = conn.cursor()
+# History rows carry attachment metadata only; images render from
+# get_thumbnail(); originals are only read to generate thumbnails
+MESSAGE_COLUMNS = "id, user_id, message_type, content, timestamp, reply_to, is_edited, reactions, attachment_sha, file_size, file_mime, file_width, file_height"
+
+def with_usernames(rows):
+    """Message rows with the sender id swapped for the username"""
+    directory = get_user_directory()
+    return [(row[0], directory.name_for(row[1]), *row[2:]) for row in rows]
+
+def get_message_history(room, limit=100, target_user=None, before=None):
+    """One page of history, newest page first, returned oldest to newest.
+
+    ``before`` is the id of the oldest message already shown; ids grow with
+    every insert, so each page is a bounded descending index range and cost
+    stays the same however far back the history goes.
+    """
+    page_filter = "AND id < ?" if before else ""
+    cursor_params = (before,) if before else ()
     
-    if target_user:
-        # Direct messages between two users
-        cursor.execute('''
-            SELECT username, message_type, content, file_data, timestamp, reply_to, is_edited, reactions
-            FROM messages 
-            WHERE ((username = ? AND target_user = ?) OR (username = ? AND target_user = ?))
-            ORDER BY timestamp ASC LIMIT ?
-        ''', (st.session_state.username, target_user, target_user, st.session_state.username, limit))
-    else:
-        # Room messages
-        cursor.execute('''
-            SELECT username, message_type, content, file_data, timestamp, reply_to, is_edited, reactions
-            FROM messages WHERE room = ? AND target_user IS NULL
-            ORDER BY timestamp ASC LIMIT ?
-        ''', (room, limit))
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        if target_user:
+            # Direct messages between two users: one ordered range per direction
+            directory = get_user_directory()
+            own_id, target_id = directory.id_for(st.session_state.username), directory.id_for(target_user)
+            cursor.execute(f'''
+                SELECT * FROM (
+                    SELECT {MESSAGE_COLUMNS}
+                    FROM messages WHERE user_id = ? AND target_id = ? {page_filter}
+                    ORDER BY id DESC LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT {MESSAGE_COLUMNS}
+                    FROM messages WHERE user_id = ? AND target_id = ? {page_filter}
+                    ORDER BY id DESC LIMIT ?
+                )
+                ORDER BY id DESC LIMIT ?
+            ''', (own_id, target_id, *cursor_params, limit,
+                  target_id, own_id, *cursor_params, limit, limit))
+        else:
+            # Room messages
+            cursor.execute(f'''
+                SELECT {MESSAGE_COLUMNS}
+                FROM messages WHERE room = ? AND target_id IS NULL {page_filter}
+                ORDER BY id DESC LIMIT ?
+            ''', (room, *cursor_params, limit))
+        
+        messages = with_usernames(cursor.fetchall())
     
-    messages = cursor.fetchall()
-    conn.close()
+    messages.reverse()
     return messages
 
-def get_online_users(room=None):
-    conn = init_database()
-    cursor = conn.cursor()
-    
-    if room:
-        cursor.execute('''
-            SELECT DISTINCT u.username, u.avatar, u.status, u.bio
-            FROM users u
-            JOIN user_sessions s ON u.username = s.username
-            WHERE s.last_activity > datetime('now', '-2 minutes')
-            ORDER BY u.username
-        ''')
+def history_cursor(messages):
+    """Keyset cursor for the page before the oldest of these messages"""
+    return messages[0][0]
+
+def get_messages_since(room, last_id, target_user=None, limit=100):
+    """Messages newer than last_id, oldest first (an idle room costs one index probe)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        if target_user:
+            directory = get_user_directory()
+            own_id, target_id = directory.id_for(st.session_state.username), directory.id_for(target_user)
+            cursor.execute(f'''
+                SELECT * FROM (
+                    SELECT {MESSAGE_COLUMNS}
+                    FROM messages WHERE user_id = ? AND target_id = ? AND id > ?
+                    ORDER BY id ASC LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT {MESSAGE_COLUMNS}
+                    FROM messages WHERE user_id = ? AND target_id = ? AND id > ?
+                    ORDER BY id ASC LIMIT ?
+                )
+                ORDER BY id ASC LIMIT ?
+            ''', (own_id, target_id, last_id, limit, target_id, own_id, last_id, limit, limit))
+        else:
+            cursor.execute(f'''
+                SELECT {MESSAGE_COLUMNS}
+                FROM messages WHERE room = ? AND target_id IS NULL AND id > ?
+                ORDER BY id ASC LIMIT ?
+            ''', (room, last_id, limit))
+
+        return with_usernames(cursor.fetchall())
+
+def load_conversation(room, target_user=None):
+    """Return this session's cached messages for a room or DM, topped up with new rows only"""
+    key = f"dm:{target_user}" if target_user else f"room:{room}"
+    entry = st.session_state.message_cache.get(key)
+
+    if entry is None:
+        messages = get_message_history(room, limit=ChatConfig.HISTORY_PAGE_SIZE, target_user=target_user)
+        entry = {
+            'messages': messages,
+            'last_id': max((msg[0] for msg in messages), default=0),
+            'has_older': len(messages) == ChatConfig.HISTORY_PAGE_SIZE,
+        }
+        st.session_state.message_cache[key] = entry
     else:
-        cursor.execute('''
-            SELECT DISTINCT u.username, u.avatar, u.status, u.bio
-            FROM users u
-            JOIN user_sessions s ON u.username = s.username
-            WHERE s.last_activity > datetime('now', '-2 minutes')
-            ORDER BY u.username
-        ''')
-    
-    users = cursor.fetchall()
-    conn.close()
-    return users
+        new_messages = get_messages_since(room, entry['last_id'], target_user)
+        if new_messages:
+            entry['messages'].extend(new_messages)
+            entry['last_id'] = new_messages[-1][0]
+            if len(entry['messages']) > ChatConfig.MESSAGE_CACHE_LIMIT:
+                del entry['messages'][:-ChatConfig.MESSAGE_CACHE_LIMIT]
+                entry['has_older'] = True
+
+    return entry['messages']
+
+def load_older_messages(room, target_user=None):
+    """Prepend the page before the oldest cached message (the "load older" button)"""
+    key = f"dm:{target_user}" if target_user else f"room:{room}"
+    entry = st.session_state.message_cache.get(key)
+    if not entry or not entry['messages']:
+        return
+
+    older = get_message_history(
+        room,
+        limit=ChatConfig.HISTORY_PAGE_SIZE,
+        target_user=target_user,
+        before=history_cursor(entry['messages'])
+    )
+    entry['messages'][:0] = older
+    entry['has_older'] = len(older) == ChatConfig.HISTORY_PAGE_SIZE
+
+def has_older_messages(room, target_user=None):
+    key = f"dm:{target_user}" if target_user else f"room:{room}"
+    entry = st.session_state.message_cache.get(key)
+    return bool(entry and entry['has_older'])
+
+def collect_attachment_garbage(min_age_seconds=3600):
+    """Delete unreferenced attachments; returns the number of files removed.
+
+    Files with no attachments row are only removed once they are older than
+    min_age_seconds, so an upload whose transaction is still open is kept.
+    """
+    store = get_attachment_store()
+    removed = 0
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Keep the write lock until the files are gone. An upload of the same
+        # bytes registers its row after this commits, finds the row missing
+        # and writes the file again (see store_attachment).
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT sha256 FROM attachments WHERE ref_count <= 0")
+        unreferenced = [row[0] for row in cursor.fetchall()]
+        cursor.executemany("DELETE FROM attachments WHERE sha256 = ?", [(sha,) for sha in unreferenced])
+        for sha256 in unreferenced:
+            store.remove(sha256)
+            removed += 1
+        commit(conn)
+        
+        # Orphans left behind by uploads that were rolled back
+        cutoff = time.time() - min_age_seconds
+        for directory, subdirectories, filenames in os.walk(store.root):
+            if directory == store.root and 'thumbs' in subdirectories:
+                subdirectories.remove('thumbs')  # removed together with their original
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                if filename.endswith('.tmp'):
+                    os.remove(path)  # interrupted write
+                    removed += 1
+                    continue
+                cursor.execute("SELECT 1 FROM attachments WHERE sha256 = ?", (filename,))
+                if cursor.fetchone() is None:
+                    store.remove(filename)  # also drops its thumbnails
+                    removed += 1
+    return removed
+
+def get_online_users(room=None):
+    """(username, avatar, status, bio) for online users, everywhere or in one room"""
+    registry = get_presence_registry()
+    users = []
+    for username, user_room, card in registry.online(room):
+        if card is None:
+            # Loaded once per user per process, refreshed after profile edits.
+            # Accounts without a password such as "system" never get a card.
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT avatar, status, bio FROM users WHERE username = ? AND password != ''", (username,))
+                card = cursor.fetchone()
+            if card is None:
+                continue
+            registry.set_card(username, card)
+        users.append((username, *card))
+    return sorted(users)
 
 def get_rooms():
-    conn = init_database()
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, description, created_by, category FROM rooms WHERE is_private = FALSE ORDER BY name")
-    rooms = cursor.fetchall()
-    conn.close()
-    return rooms
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, description, created_by, category FROM rooms WHERE is_private = FALSE ORDER BY name")
+        return cursor.fetchall()
 
 def create_room(room_name, description, username, is_private=False, password=None, category='general', tags=''):
-    conn = init_database()
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO rooms (name, description, created_by, is_private, password, category, tags) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (room_name, description, username, is_private, hash_password(password) if password else None, category, tags)
+            )
+            commit(conn)
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+class ProfileViewCounter:
+    """Profile view increments buffered in memory until the next flush"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, username, views=1):
+        with self._lock:
+            self._pending[username] = self._pending.get(username, 0) + views
+
+    def take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+def flush_profile_views(counter):
+    """Apply all buffered views in one transaction; returns the users updated"""
+    pending = counter.take()
+    if not pending:
+        return 0
     try:
-        cursor.execute(
-            "INSERT INTO rooms (name, description, created_by, is_private, password, category, tags) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (room_name, description, username, is_private, hash_password(password) if password else None, category, tags)
-        )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE users SET profile_views = profile_views + ? WHERE username = ?",
+                [(views, username) for username, views in pending.items()]
+            )
+            commit(conn)
+    except sqlite3.Error:
+        # Keep the views for the next flush
+        for username, views in pending.items():
+            counter.add(username, views)
+        raise
+    return len(pending)
 
-def get_user_profile(username):
-    conn = init_database()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT username, avatar, status, bio, interests, location, last_seen, profile_views FROM users WHERE username = ?",
-        (username,)
-    )
-    profile = cursor.fetchone()
+@st.cache_resource
+def get_profile_view_counter():
+    counter = ProfileViewCounter()
     
-    # Update profile views
-    if profile and username != st.session_state.username:
+    def flush_loop():
+        while True:
+            time.sleep(ChatConfig.PROFILE_VIEW_FLUSH_SECONDS)
+            try:
+                flush_profile_views(counter)
+            except sqlite3.Error:
+                pass  # retried on the next tick
+    
+    threading.Thread(target=flush_loop, name="profile-view-flush", daemon=True).start()
+    return counter
+
+@st.cache_data(ttl=ChatConfig.PROFILE_CACHE_SECONDS, show_spinner=False)
+def load_user_profile(username):
+    with db_connection() as conn:
+        cursor = conn.cursor()
         cursor.execute(
-            "UPDATE users SET profile_views = profile_views + 1 WHERE username = ?",
+            "SELECT username, avatar, status, bio, interests, location, last_seen, profile_views FROM users WHERE username = ?",
             (username,)
         )
-        conn.commit()
-    
-    conn.close()
+        return cursor.fetchone()
+
+def get_user_profile(username):
+    """Cached profile row; a view by another user is only counted in memory"""
+    profile = load_user_profile(username)
+    if profile and username != st.session_state.username:
+        get_profile_view_counter().add(username)
     return profile
 
-def send_friend_request(from_user, to_user, message=""):
-    conn = init_database()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO friend_requests (from_user, to_user, message) VALUES (?, ?, ?)",
-            (from_user, to_user, message)
-        )
-        
-        # Add notification
+def update_user_profile(username, bio, interests, location):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, interests FROM users WHERE username = ?", (username,))
+        row = cursor.fetchone()
         cursor.execute(
-            "INSERT INTO notifications (username, type, content) VALUES (?, ?, ?)",
-            (to_user, 'friend_request', f"{from_user} sent you a friend request!")
+            "UPDATE users SET bio = ?, interests = ?, location = ? WHERE username = ?",
+            (bio, interests, location, username)
         )
-        
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+        if row:
+            index_interests(cursor, row[0], row[1], interests)
+        commit(conn)
+    load_user_profile.clear(username)
+    get_presence_registry().forget_card(username)
+
+def send_friend_request(from_user, to_user, message=""):
+    directory = get_user_directory()
+    from_id, to_id = directory.id_for(from_user), directory.id_for(to_user)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if are_friends(cursor, from_id, to_id):
+            return False
+        try:
+            cursor.execute(
+                "INSERT INTO friend_requests (from_id, to_id, message) VALUES (?, ?, ?)",
+                (from_id, to_id, message)
+            )
+            
+            insert_notification(cursor, to_id, 'friend_request', f"{from_user} sent you a friend request!")
+            log_change(cursor, user_channel(to_user))
+            
+            commit(conn)
+            get_message_broker().publish(user_channel(to_user))
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 def get_friend_requests(username):
-    conn = init_database()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT fr.id, fr.from_user, fr.message, fr.sent_at, u.avatar 
-        FROM friend_requests fr
-        JOIN users u ON fr.from_user = u.username
-        WHERE fr.to_user = ? AND fr.status = 'pending'
-        ORDER BY fr.sent_at DESC
-    ''', (username,))
-    requests = cursor.fetchall()
-    conn.close()
-    return requests
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT fr.id, u.username, fr.message, fr.sent_at, u.avatar 
+            FROM friend_requests fr
+            JOIN users u ON u.id = fr.from_id
+            WHERE fr.to_id = ? AND fr.status = 'pending'
+            ORDER BY fr.sent_at DESC
+        ''', (get_user_id(username),))
+        return cursor.fetchall()
 
 def respond_to_friend_request(request_id, response):
-    conn = init_database()
-    cursor = conn.cursor()
-    
-    # Get request details
-    cursor.execute('SELECT from_user, to_user FROM friend_requests WHERE id = ?', (request_id,))
-    request = cursor.fetchone()
-    
-    if request:
-        from_user, to_user = request
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
         
-        if response == 'accept':
-            # Add to friends table
-            cursor.execute(
-                "INSERT INTO friends (user1, user2, status) VALUES (?, ?, 'accepted')",
-                (from_user, to_user)
-            )
-            # Add notification
+        # Get request details
+        cursor.execute('SELECT from_id, to_id FROM friend_requests WHERE id = ?', (request_id,))
+        request = cursor.fetchone()
+        
+        if request:
+            from_id, to_id = request
+            directory = get_user_directory()
+            from_user, to_user = directory.name_for(from_id), directory.name_for(to_id)
+            
+            if response == 'accept':
+                # Add to friends table
+                cursor.execute(
+                    "INSERT INTO friends (user1_id, user2_id, status) VALUES (?, ?, 'accepted')",
+                    (from_id, to_id)
+                )
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO friend_edges (user_id, friend_id) VALUES (?, ?)",
+                    [(from_id, to_id), (to_id, from_id)]
+                )
+                insert_notification(cursor, from_id, 'friend_accepted', f"{to_user} accepted your friend request!")
+                index_friendship(cursor, from_id, to_id)
+                record_interaction(from_user, to_user, 'friend')
+            
+            # Update request status
             cursor.execute(
-                "INSERT INTO notifications (username, type, content) VALUES (?, ?, ?)",
-                (from_user, 'friend_accepted', f"{to_user} accepted your friend request!")
+                "UPDATE friend_requests SET status = ? WHERE id = ?",
+                (response, request_id)
             )
-            record_interaction(from_user, to_user, 'friend')
-        
-        # Update request status
-        cursor.execute(
-            "UPDATE friend_requests SET status = ? WHERE id = ?",
-            (response, request_id)
-        )
-        
-        conn.commit()
+            log_change(cursor, user_channel(from_user))
+            log_change(cursor, user_channel(to_user))
     
-    conn.close()
+    if request:
+        get_friend_cache().invalidate(from_user, to_user)
+        broker = get_message_broker()
+        broker.publish(user_channel(from_user))
+        broker.publish(user_channel(to_user))
 
 def get_friends(username):
-    conn = init_database()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT 
-            CASE WHEN f.user1 = ? THEN f.user2 ELSE f.user1 END as friend_username,
-            u.avatar, u.status, u.bio, u.last_seen
-        FROM friends f
-        JOIN users u ON (CASE WHEN f.user1 = ? THEN f.user2 ELSE f.user1 END) = u.username
-        WHERE (f.user1 = ? OR f.user2 = ?) AND f.status = 'accepted'
-        ORDER BY u.status DESC, u.last_seen DESC
-    ''', (username, username, username, username))
-    friends = cursor.fetchall()
-    conn.close()
-    return friends
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.username, u.avatar, u.status, u.bio, u.last_seen
+            FROM friend_edges e
+            JOIN users u ON u.id = e.friend_id
+            WHERE e.user_id = ?
+            ORDER BY u.status DESC, u.last_seen DESC
+        ''', (get_user_id(username),))
+        return cursor.fetchall()
+
+class FriendSetCache:
+    """Per-user friend sets with a TTL, invalidated when a friendship changes"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sets = {}
+
+    def get(self, username):
+        with self._lock:
+            entry = self._sets.get(username)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        with db_connection() as conn:
+            friends = frozenset(friend_set(conn.cursor(), username))
+        with self._lock:
+            self._sets[username] = (friends, time.monotonic() + self.ttl)
+        return friends
+
+    def invalidate(self, *usernames):
+        with self._lock:
+            for username in usernames:
+                self._sets.pop(username, None)
+
+@st.cache_resource
+def get_friend_cache():
+    return FriendSetCache(ChatConfig.FRIEND_CACHE_SECONDS)
+
+def get_friend_set(username):
+    return get_friend_cache().get(username)
+
+def insert_notification(cursor, user_id, notification_type, content):
+    cursor.execute(
+        "INSERT INTO notifications (user_id, type, content) VALUES (?, ?, ?)",
+        (user_id, notification_type, content)
+    )
+    bump_unread(cursor, user_id, NOTIFICATION_FEED)
 
 def get_notifications(username):
-    conn = init_database()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT type, content, created_at, is_read 
-        FROM notifications 
-        WHERE username = ? 
-        ORDER BY created_at DESC 
-        LIMIT 20
-    ''', (username,))
-    notifications = cursor.fetchall()
-    conn.close()
-    return notifications
+    """Latest notifications; anything past the feed's read cursor is unread"""
+    user_id = get_user_id(username)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT type, content, created_at, id <= COALESCE(
+                (SELECT last_read_id FROM read_cursors WHERE user_id = ? AND conversation = ?), 0
+            )
+            FROM notifications 
+            WHERE user_id = ? 
+            ORDER BY id DESC 
+            LIMIT 20
+        ''', (user_id, NOTIFICATION_FEED, user_id))
+        return cursor.fetchall()
 
 def mark_notification_read(username):
-    conn = init_database()
-    cursor = conn.cursor()
+    # One cursor row moves instead of every unread notification being updated
+    user_id = get_user_id(username)
+    if user_id is None:
+        return
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(id) FROM notifications WHERE user_id = ?", (user_id,))
+        advance_read_cursor(cursor, user_id, NOTIFICATION_FEED, cursor.fetchone()[0] or 0)
+        commit(conn)
+
+# Read cursors and unread counters. Conversations are named from the
+# reader's side: "room:<name>", "dm:<peer user id>" or the notification feed.
+# Room and feed cursors live in read_cursors, DM cursors on the conversations row.
+# A room badge is its message counter minus the counter value the reader's
+# cursor has accounted for; the feed and DMs keep an unread count per reader.
+NOTIFICATION_FEED = 'notifications'
+
+def room_conversation(room):
+    return f"room:{room}"
+
+def dm_conversation(peer_id):
+    return f"dm:{peer_id}"
+
+def bump_unread(cursor, user_id, conversation):
     cursor.execute('''
-        UPDATE notifications SET is_read = TRUE 
-        WHERE username = ? AND is_read = FALSE
-    ''', (username,))
-    conn.commit()
-    conn.close()
+        INSERT INTO read_cursors (user_id, conversation, unread) VALUES (?, ?, 1)
+        ON CONFLICT(user_id, conversation) DO UPDATE SET unread = unread + 1
+    ''', (user_id, conversation))
 
-def record_interaction(user1, user2, interaction_type):
-    conn = init_database()
-    cursor = conn.cursor()
-    
-    # Ensure consistent ordering of usernames
-    sorted_users = sorted([user1, user2])
-    user1_sorted, user2_sorted = sorted_users
+def bump_room_counter(cursor, room, sender_id):
+    """Count a new room message; the sender's own cursor accounts for it straight away"""
+    conversation = room_conversation(room)
+    cursor.execute('''
+        INSERT INTO message_counters (conversation, message_count) VALUES (?, 1)
+        ON CONFLICT(conversation) DO UPDATE SET message_count = message_count + 1
+    ''', (conversation,))
+    cursor.execute(
+        "UPDATE read_cursors SET read_count = read_count + 1 WHERE user_id = ? AND conversation = ?",
+        (sender_id, conversation)
+    )
+
+def count_unread(cursor, user_id, conversation, after_id):
+    """Items newer than after_id in a conversation, not counting the reader's own"""
+    kind, _, key = conversation.partition(':')
+    if kind == 'room':
+        cursor.execute(
+            "SELECT COUNT(*) FROM messages WHERE room = ? AND target_id IS NULL AND id > ? AND user_id != ?",
+            (key, after_id, user_id)
+        )
+    elif kind == 'dm':
+        cursor.execute(
+            "SELECT COUNT(*) FROM messages WHERE user_id = ? AND target_id = ? AND id > ?",
+            (int(key), user_id, after_id)
+        )
+    else:
+        cursor.execute("SELECT COUNT(*) FROM notifications WHERE user_id = ? AND id > ?", (user_id, after_id))
+    return cursor.fetchone()[0]
+
+def advance_read_cursor(cursor, user_id, conversation, last_read_id):
+    """Mark a conversation read up to last_read_id; the caller commits.
+
+    The counter is recounted from the cursor rather than zeroed, so items
+    that arrived after last_read_id stay unread. That count is an index
+    range over the new items only, usually empty. A room cursor stores it
+    as the room counter minus what is still unread.
+    """
+    cursor.execute(
+        "SELECT last_read_id FROM read_cursors WHERE user_id = ? AND conversation = ?",
+        (user_id, conversation)
+    )
+    row = cursor.fetchone()
+    if row is not None and row[0] >= last_read_id:
+        return False
+    unread, read_count = count_unread(cursor, user_id, conversation, last_read_id), 0
+    if conversation.startswith('room:'):
+        cursor.execute("SELECT message_count FROM message_counters WHERE conversation = ?", (conversation,))
+        counter = cursor.fetchone()
+        unread, read_count = 0, (counter[0] if counter else 0) - unread
+    cursor.execute('''
+        INSERT INTO read_cursors (user_id, conversation, last_read_id, unread, read_count) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, conversation) DO UPDATE SET
+            last_read_id = excluded.last_read_id, unread = excluded.unread, read_count = excluded.read_count
+    ''', (user_id, conversation, last_read_id, unread, read_count))
+    return True
+
+def conversation_side(user_id, peer_id):
+    """(user_low, user_high, reader's column prefix) of a DM pair"""
+    if user_id <= peer_id:
+        return user_id, peer_id, 'low'
+    return peer_id, user_id, 'high'
+
+def touch_conversation(cursor, sender_id, recipient_id, message_id):
+    """Point the pair's conversation row at a new message and bump the recipient's counter"""
+    user_low, user_high, side = conversation_side(recipient_id, sender_id)
+    cursor.execute(f'''
+        INSERT INTO conversations (user_low, user_high, last_message_id, last_message_at, {side}_unread)
+        SELECT ?, ?, id, timestamp, 1 FROM messages WHERE id = ?
+        ON CONFLICT(user_low, user_high) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_message_at = excluded.last_message_at,
+            {side}_unread = {side}_unread + 1
+    ''', (user_low, user_high, message_id))
+
+def advance_dm_cursor(cursor, user_id, peer_id, last_read_id):
+    """advance_read_cursor for a DM, whose cursor is the reader's side of the conversation row"""
+    user_low, user_high, side = conversation_side(user_id, peer_id)
+    cursor.execute(
+        f"SELECT {side}_read_id FROM conversations WHERE user_low = ? AND user_high = ?",
+        (user_low, user_high)
+    )
+    row = cursor.fetchone()
+    if row is None or row[0] >= last_read_id:
+        return False
+    cursor.execute(
+        f"UPDATE conversations SET {side}_read_id = ?, {side}_unread = ? WHERE user_low = ? AND user_high = ?",
+        (last_read_id, count_unread(cursor, user_id, dm_conversation(peer_id), last_read_id), user_low, user_high)
+    )
+    return True
+
+def mark_conversation_read(username, room, target_user=None):
+    """Advance the reader's cursor to the newest message this session has shown"""
+    key = f"dm:{target_user}" if target_user else f"room:{room}"
+    entry = st.session_state.message_cache.get(key)
+    if entry is None or entry.get('read_id') == entry['last_id']:
+        return
+    directory = get_user_directory()
+    user_id = directory.id_for(username)
+    with db_connection() as conn:
+        if target_user:
+            advanced = advance_dm_cursor(conn.cursor(), user_id, directory.id_for(target_user), entry['last_id'])
+        else:
+            advanced = advance_read_cursor(conn.cursor(), user_id, room_conversation(room), entry['last_id'])
+        if advanced:
+            commit(conn)
+    entry['read_id'] = entry['last_id']
+
+def get_unread_counts(username):
+    """conversation -> unread count for every conversation with something unread"""
+    user_id = get_user_id(username)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT conversation, unread FROM read_cursors WHERE user_id = ? AND unread > 0
+            UNION ALL
+            SELECT r.conversation, c.message_count - r.read_count
+            FROM read_cursors r JOIN message_counters c ON c.conversation = r.conversation
+            WHERE r.user_id = ? AND c.message_count > r.read_count
+            UNION ALL
+            SELECT 'dm:' || user_high, low_unread FROM conversations WHERE user_low = ? AND low_unread > 0
+            UNION ALL
+            SELECT 'dm:' || user_low, high_unread FROM conversations WHERE user_high = ? AND high_unread > 0
+        ''', (user_id, user_id, user_id, user_id))
+        return dict(cursor.fetchall())
+
+def get_conversations(username, limit=50):
+    """The user's DM conversations, most recent first, with a preview of the last message.
+
+    Rows are (peer, avatar, status, last sender, message type, content,
+    timestamp, unread). The user is the low or the high id of a pair, so
+    this merges the newest ``limit`` rows of each side's index range; the
+    preview and the peer are primary key lookups.
+    """
+    side_query = '''
+        SELECT * FROM (
+            SELECT u.username, u.avatar, u.status, m.user_id, m.message_type, m.content,
+                   c.last_message_at, c.{side}_unread, c.last_message_id
+            FROM conversations c
+            JOIN messages m ON m.id = c.last_message_id
+            JOIN users u ON u.id = c.{peer}
+            WHERE c.{reader} = ?
+            ORDER BY c.last_message_id DESC LIMIT ?
+        )
+    '''
+    user_id = get_user_id(username)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            {side_query.format(side='low', reader='user_low', peer='user_high')}
+            UNION ALL
+            {side_query.format(side='high', reader='user_high', peer='user_low')}
+            ORDER BY last_message_id DESC LIMIT ?
+        ''', (user_id, limit, user_id, limit, limit))
+        directory = get_user_directory()
+        return [(*row[:3], directory.name_for(row[3]), *row[4:8]) for row in cursor.fetchall()]
+
+def insert_interaction(cursor, user1, user2, interaction_type):
+    # Ensure consistent ordering of user ids
+    directory = get_user_directory()
+    user1_sorted, user2_sorted = sorted([directory.id_for(user1), directory.id_for(user2)])
     
     cursor.execute('''
         INSERT OR REPLACE INTO user_interactions 
-        (user1, user2, interaction_type, strength, last_interaction)
-        VALUES (?, ?, ?, COALESCE((SELECT strength FROM user_interactions WHERE user1 = ? AND user2 = ?), 0) + 1, CURRENT_TIMESTAMP)
+        (user1_id, user2_id, interaction_type, strength, last_interaction)
+        VALUES (?, ?, ?, COALESCE((SELECT strength FROM user_interactions WHERE user1_id = ? AND user2_id = ?), 0) + 1, CURRENT_TIMESTAMP)
     ''', (user1_sorted, user2_sorted, interaction_type, user1_sorted, user2_sorted))
-    
-    conn.commit()
-    conn.close()
+    index_interaction(cursor, user1_sorted, user2_sorted)
 
-def get_user_recommendations(username, limit=5):
-    conn = init_database()
-    cursor = conn.cursor()
-    
-    # Get users with similar interactions or interests
+def record_interaction(user1, user2, interaction_type):
+    with db_connection() as conn:
+        insert_interaction(conn.cursor(), user1, user2, interaction_type)
+        commit(conn)
+
+# "People you may know" index. user_recommendations holds a precomputed
+# score per (user, candidate); it is kept current by the write helpers
+# below and recomputed from scratch by rebuild_recommendations(). The
+# index helpers take user ids.
+def interest_set(interests):
+    return {interest.strip().lower() for interest in (interests or '').split(',') if interest.strip()}
+
+def friend_ids(cursor, user_id):
+    cursor.execute("SELECT friend_id FROM friend_edges WHERE user_id = ?", (user_id,))
+    return {row[0] for row in cursor.fetchall()}
+
+def friend_set(cursor, username):
+    """Usernames of a user's friends"""
     cursor.execute('''
-        SELECT u.username, u.avatar, u.bio, u.status,
-               COUNT(DISTINCT ui.interaction_type) as common_interactions
-        FROM users u
-        LEFT JOIN user_interactions ui ON (ui.user1 = ? AND ui.user2 = u.username) 
-                                      OR (ui.user2 = ? AND ui.user1 = u.username)
-        WHERE u.username != ? 
-          AND u.username NOT IN (
-              SELECT CASE WHEN user1 = ? THEN user2 ELSE user1 END 
-              FROM friends 
-              WHERE user1 = ? OR user2 = ?
-          )
-        GROUP BY u.username
-        ORDER BY common_interactions DESC, u.profile_views DESC
+        SELECT u.username FROM friend_edges e JOIN users u ON u.id = e.friend_id
+        WHERE e.user_id = ?
+    ''', (get_user_id(username),))
+    return {row[0] for row in cursor.fetchall()}
+
+def bump_recommendations(cursor, pairs, component, delta=1):
+    """Add delta to one score component of each (user_id, candidate_id) pair"""
+    weight = ChatConfig.RECOMMENDATION_WEIGHTS[component]
+    if delta > 0:
+        cursor.executemany(f'''
+            INSERT INTO user_recommendations (user_id, candidate_id, {component}, score)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, candidate_id) DO UPDATE SET
+                {component} = {component} + excluded.{component},
+                score = score + excluded.score
+        ''', [(user_id, candidate_id, delta, delta * weight) for user_id, candidate_id in pairs])
+    else:
+        # Decrements only touch existing rows; rows that reach zero stop being listed
+        cursor.executemany(f'''
+            UPDATE user_recommendations
+            SET {component} = MAX({component} + ?, 0), score = score - MIN({component}, ?) * ?
+            WHERE user_id = ? AND candidate_id = ?
+        ''', [(delta, -delta, weight, user_id, candidate_id) for user_id, candidate_id in pairs])
+
+def index_friendship(cursor, user1, user2):
+    """Update the index for a new friendship; call after the friends row exists"""
+    friends1 = friend_ids(cursor, user1) - {user2}
+    friends2 = friend_ids(cursor, user2) - {user1}
+    cursor.executemany(
+        "DELETE FROM user_recommendations WHERE user_id = ? AND candidate_id = ?",
+        [(user1, user2), (user2, user1)]
+    )
+    # Each of user2's other friends gains user2 as a mutual friend with user1, and vice versa
+    pairs = []
+    for user, others, own_friends in ((user1, friends2, friends1), (user2, friends1, friends2)):
+        for other in others - own_friends - {user}:
+            pairs += [(user, other), (other, user)]
+    bump_recommendations(cursor, pairs, 'mutual_friends')
+
+def are_friends(cursor, user1, user2):
+    cursor.execute("SELECT 1 FROM friend_edges WHERE user_id = ? AND friend_id = ?", (user1, user2))
+    return cursor.fetchone() is not None
+
+def index_interaction(cursor, user1, user2):
+    if user1 != user2 and not are_friends(cursor, user1, user2):
+        bump_recommendations(cursor, [(user1, user2), (user2, user1)], 'interaction_strength')
+
+def interest_leaders(cursor, interest, user_id):
+    cursor.execute('''
+        SELECT ui.user_id FROM user_interests ui
+        JOIN users u ON u.id = ui.user_id
+        WHERE ui.interest = ? AND ui.user_id != ?
+        ORDER BY u.profile_views DESC
         LIMIT ?
-    ''', (username, username, username, username, username, username, limit))
+    ''', (interest, user_id, ChatConfig.RECOMMENDATION_INTEREST_LEADERS))
+    return [row[0] for row in cursor.fetchall()]
+
+def index_interests(cursor, user_id, old_interests, new_interests):
+    """Point a user at the most-viewed people sharing each newly listed interest"""
+    old, new = interest_set(old_interests), interest_set(new_interests)
+    if old == new:
+        return
+    friends = friend_ids(cursor, user_id)
+    for interest in old - new:
+        cursor.execute("DELETE FROM user_interests WHERE interest = ? AND user_id = ?", (interest, user_id))
+        leaders = interest_leaders(cursor, interest, user_id)
+        bump_recommendations(cursor, [(user_id, leader) for leader in leaders], 'shared_interests', -1)
+    for interest in new - old:
+        leaders = interest_leaders(cursor, interest, user_id)
+        cursor.execute("INSERT OR IGNORE INTO user_interests (interest, user_id) VALUES (?, ?)", (interest, user_id))
+        bump_recommendations(cursor, [(user_id, leader) for leader in leaders if leader not in friends], 'shared_interests')
+
+def rebuild_recommendations(cursor):
+    """Recompute user_interests and user_recommendations with set-based SQL"""
+    weights = ChatConfig.RECOMMENDATION_WEIGHTS
+    cursor.execute("DELETE FROM user_recommendations")
+    cursor.execute("DELETE FROM user_interests")
+    cursor.execute("SELECT id, interests FROM users WHERE interests != ''")
+    rows = cursor.fetchall()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO user_interests (interest, user_id) VALUES (?, ?)",
+        [(interest, user_id) for user_id, interests in rows for interest in interest_set(interests)]
+    )
+    
+    cursor.execute('''
+        INSERT INTO user_recommendations (user_id, candidate_id, mutual_friends, score)
+        SELECT e1.user_id, e2.friend_id, COUNT(*), COUNT(*) * ?
+        FROM friend_edges e1 JOIN friend_edges e2 ON e2.user_id = e1.friend_id
+        WHERE e2.friend_id != e1.user_id
+          AND NOT EXISTS (SELECT 1 FROM friend_edges f WHERE f.user_id = e1.user_id AND f.friend_id = e2.friend_id)
+        GROUP BY e1.user_id, e2.friend_id
+    ''', (weights['mutual_friends'],))
+    cursor.execute('''
+        WITH ranked AS (
+            SELECT ui.interest, ui.user_id,
+                   ROW_NUMBER() OVER (PARTITION BY ui.interest ORDER BY u.profile_views DESC) AS position
+            FROM user_interests ui JOIN users u ON u.id = ui.user_id
+        )
+        INSERT INTO user_recommendations (user_id, candidate_id, shared_interests, score)
+        SELECT ui.user_id, leader.user_id, COUNT(*), COUNT(*) * ?
+        FROM user_interests ui JOIN ranked leader ON leader.interest = ui.interest AND leader.position <= ?
+        WHERE leader.user_id != ui.user_id
+          AND NOT EXISTS (SELECT 1 FROM friend_edges f WHERE f.user_id = ui.user_id AND f.friend_id = leader.user_id)
+        GROUP BY ui.user_id, leader.user_id
+        ON CONFLICT(user_id, candidate_id) DO UPDATE SET
+            shared_interests = excluded.shared_interests, score = score + excluded.score
+    ''', (weights['shared_interests'], ChatConfig.RECOMMENDATION_INTEREST_LEADERS))
+    cursor.execute('''
+        WITH pairs AS (
+            SELECT user1_id AS a, user2_id AS b FROM user_interactions WHERE user1_id != user2_id
+            UNION ALL
+            SELECT user2_id, user1_id FROM user_interactions WHERE user1_id != user2_id
+        )
+        INSERT INTO user_recommendations (user_id, candidate_id, interaction_strength, score)
+        SELECT a, b, COUNT(*), COUNT(*) * ? FROM pairs
+        WHERE NOT EXISTS (SELECT 1 FROM friend_edges f WHERE f.user_id = pairs.a AND f.friend_id = pairs.b)
+        GROUP BY a, b
+        ON CONFLICT(user_id, candidate_id) DO UPDATE SET
+            interaction_strength = excluded.interaction_strength, score = score + excluded.score
+    ''', (weights['interaction_strength'],))
     
-    recommendations = cursor.fetchall()
-    conn.close()
-    return recommendations
+    # Only the best candidates per user are worth keeping
+    cursor.execute('''
+        DELETE FROM user_recommendations WHERE (user_id, candidate_id) IN (
+            SELECT user_id, candidate_id FROM (
+                SELECT user_id, candidate_id,
+                       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY score DESC) AS position
+                FROM user_recommendations
+            ) WHERE position > ?
+        )
+    ''', (ChatConfig.RECOMMENDATION_KEEP,))
+    cursor.execute("SELECT COUNT(*) FROM user_recommendations")
+    return cursor.fetchone()[0]
+
+def get_user_recommendations(username, limit=5):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.username, u.avatar, u.bio, u.status, r.score
+            FROM user_recommendations r
+            JOIN users u ON u.id = r.candidate_id
+            WHERE r.user_id = ? AND r.score > 0
+            ORDER BY r.score DESC
+            LIMIT ?
+        ''', (get_user_id(username), limit))
+        recommendations = cursor.fetchall()
+        if recommendations:
+            return recommendations
+        
+        # Nothing in common with anyone yet: suggest the most viewed people,
+        # skipping accounts without a password such as "system"
+        excluded = friend_set(cursor, username) | {username}
+        cursor.execute('''
+            SELECT username, avatar, bio, status, 0 FROM users
+            WHERE password != ''
+            ORDER BY profile_views DESC
+            LIMIT ?
+        ''', (limit + len(excluded),))
+        return [row for row in cursor.fetchall() if row[0] not in excluded][:limit]
+
+# Query plan verification
+# Tables a helper is allowed to scan, keyed by helper name. The cold-start
+# recommendation fallback walks idx_users_views in order and stops at its
+# LIMIT; the indexed lookup aliases users as u, so it is still checked.
+ALLOWED_SCANS = {
+    'get_user_recommendations': {'users'},
+}
+
+def plan_check_views(username):
+    counter = ProfileViewCounter()
+    counter.add(username)
+    return counter
+
+def plan_check_write(helper, *args):
+    """Call a cursor-level write helper inside the verify_query_plans dry run"""
+    with db_connection() as conn:
+        helper(conn.cursor(), *args)
+
+def plan_check_peer(username):
+    """Some other account to probe DMs and pair indexes with, None on an empty database"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT username FROM users WHERE username != ? AND password != '' LIMIT 1", (username,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+def plan_check_send(username, room, target_user=None):
+    """save_message on the synchronous path, inside the verify_query_plans dry run"""
+    registry = get_presence_registry()
+    write_behind, ChatConfig.WRITE_BEHIND = ChatConfig.WRITE_BEHIND, False
+    try:
+        save_message(room, username, 'text', 'plan check', target_user=target_user)
+    finally:
+        ChatConfig.WRITE_BEHIND = write_behind
+        # The send's presence heartbeat must not reach the snapshot either
+        registry.take_dirty()
+
+def plan_check_probes(username):
+    """(helper name, call) pairs covering every query issued while rendering the chat UI"""
+    # DM probes use a real account so their plans are for real keys; on an
+    # empty database they fall back to a name without an id
+    peer = plan_check_peer(username)
+    user_id, peer_id = get_user_id(username), get_user_id(peer) if peer else None
+    peer = peer or f"{username}-peer"
+    probes = [
+        ('authenticate_user', lambda: authenticate_user(username, '')),
+        ('get_message_history', lambda: get_message_history('general')),
+        ('get_message_history (direct)', lambda: get_message_history('direct', target_user=peer)),
+        ('get_message_history (older page)', lambda: get_message_history('general', before=2**62)),
+        ('get_message_history (direct, older page)', lambda: get_message_history('direct', target_user=peer, before=2**62)),
+        ('get_messages_since', lambda: get_messages_since('general', 0)),
+        ('get_messages_since (direct)', lambda: get_messages_since('direct', 0, target_user=peer)),
+        ('get_online_users', lambda: get_online_users('general')),
+        ('persist_presence', lambda: persist_presence(get_presence_registry())),
+        ('read_changes', lambda: read_changes(0)),
+        ('prune_change_log', lambda: prune_change_log(ChatConfig.CHANGE_LOG_KEEP)),
+        ('get_rooms', get_rooms),
+        ('get_user_profile', lambda: load_user_profile(username)),
+        ('flush_profile_views', lambda: flush_profile_views(plan_check_views(username))),
+        ('get_friend_requests', lambda: get_friend_requests(username)),
+        ('get_friends', lambda: get_friends(username)),
+        ('get_friend_set', lambda: get_friend_cache().invalidate(username) or get_friend_set(username)),
+        ('get_notifications', lambda: get_notifications(username)),
+        ('mark_notification_read', lambda: mark_notification_read(username)),
+        ('get_unread_counts', lambda: get_unread_counts(username)),
+        ('advance_read_cursor (room)', lambda: plan_check_write(advance_read_cursor, get_user_id(username) or 0, room_conversation('general'), 2**62)),
+        ('advance_dm_cursor', lambda: plan_check_write(advance_dm_cursor, user_id or 0, peer_id or 0, 2**62)),
+        ('get_conversations', lambda: get_conversations(username)),
+        ('bump_room_counter', lambda: plan_check_write(bump_room_counter, 'general', get_user_id(username) or 0)),
+        ('get_user_recommendations', lambda: get_user_recommendations(username)),
+        ('index_interests', lambda: plan_check_write(index_interests, get_user_id(username), 'plans', 'checks')),
+    ]
+    # Writes need real accounts; NULL ids would violate their keys
+    if user_id is not None:
+        probes.append(('save_message', lambda: plan_check_send(username, 'general')))
+    if user_id is not None and peer_id is not None:
+        probes += [
+            ('save_message (direct)', lambda: plan_check_send(username, 'direct', target_user=peer)),
+            ('index_friendship', lambda: plan_check_write(index_friendship, user_id, peer_id)),
+            ('index_interaction', lambda: plan_check_write(index_interaction, user_id, peer_id)),
+        ]
+    return probes
+
+def verify_query_plans(username='plan-check'):
+    """Run EXPLAIN QUERY PLAN on every statement issued by the chat helpers.
+
+    Returns (helper, sql, plan details, offending scans) for each statement;
+    a statement fails when its plan scans a table outside ALLOWED_SCANS.
+    The probes call real write helpers, so they share one transaction that
+    is always rolled back and the checked database is left as it was.
+    """
+    st.session_state.username = username
+    results = []
+    with get_connection_pool().dry_run() as conn:
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            for helper, probe in plan_check_probes(username):
+                statements.clear()
+                probe()
+                for sql in list(statements):
+                    kind = sql.split(None, 1)[0].upper()
+                    # An INSERT only has a plan worth checking if it reads something
+                    if kind not in ('SELECT', 'UPDATE', 'DELETE') and not (
+                        kind in ('INSERT', 'REPLACE') and 'SELECT' in sql.upper()
+                    ):
+                        continue
+                    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+                    scans = [
+                        detail for detail in plan
+                        # Scanning a bounded subquery result is fine, scanning a table is not
+                        if detail.startswith('SCAN ') and detail != 'SCAN CONSTANT ROW'
+                        and not detail.split()[1].startswith('(')
+                        and detail.split()[1] not in ALLOWED_SCANS.get(helper, ())
+                    ]
+                    results.append((helper, ' '.join(sql.split()), plan, scans))
+        finally:
+            conn.set_trace_callback(None)
+    return results
 
 # Initialize session state
 if 'authenticated' not in st.session_state:
@@ -598,7 +2644,13 @@ if 'current_room' not in st.session_state:
 if 'current_chat' not in st.session_state:
     st.session_state.current_chat = None  # For direct messaging
 if 'active_tab' not in st.session_state:
-    st.session_state.active_tab = "chat"
+    st.session_state.active_tab = "💬 Group Chat"
+if 'message_cache' not in st.session_state:
+    st.session_state.message_cache = {}  # conversation key -> {'messages', 'last_id'}
+if 'refresh_interval' not in st.session_state:
+    st.session_state.refresh_interval = ChatConfig.REFRESH_MIN_SECONDS
+if 'unread_counts' not in st.session_state:
+    st.session_state.unread_counts = {}  # conversation -> unread, read once per run
 
 # Enhanced emoji support
 EMOJIS = {
@@ -609,42 +2661,89 @@ EMOJIS = {
     "🌈": "rainbow", "🤖": "robot", "👻": "ghost", "🎨": "art"
 }
 
-def display_message(username, content, message_type='text', file_data=None, timestamp=None, reply_to=None, is_edited=False, reactions=None):
-    timestamp_str = timestamp[:16] if timestamp else ""
+@lru_cache(maxsize=4096)
+def format_minute(minute):
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(minute * 60))
+
+def format_timestamp(epoch_ms):
+    """Epoch milliseconds as 'YYYY-MM-DD HH:MM' UTC, formatted once per distinct minute"""
+    return format_minute(epoch_ms // 60000) if epoch_ms else ""
+
+def message_html(username, content, message_type='text', timestamp=None, is_edited=False, own=False):
+    """One message as a single-line HTML fragment, with user text escaped"""
+    timestamp_str = format_timestamp(timestamp)
+    # A blank line would end the surrounding HTML block in markdown
+    content = html.escape(content or "").replace("\n", "<br>")
     
     if username == "system":
-        st.markdown(f"""
-        <div class="chat-message system-message">
-            🔔 {content} • {timestamp_str}
-        </div>
-        """, unsafe_allow_html=True)
+        return f'<div class="chat-message system-message">🔔 {content} • {timestamp_str}</div>'
     
-    elif message_type == 'text':
-        message_class = "user-message" if username == st.session_state.username else "other-message"
-        
-        edited_text = " ✏️" if is_edited else ""
-        
-        st.markdown(f"""
-        <div class="chat-message {message_class}">
-            <strong>{username}</strong>{edited_text} • {timestamp_str}<br>
-            {content}
-        </div>
-        """, unsafe_allow_html=True)
+    message_class = "user-message" if own else "other-message"
+    if message_type == 'image':
+        return f'<div class="chat-message {message_class}"><strong>{html.escape(username)}</strong> sent an image • {timestamp_str}<br></div>'
     
-    elif message_type == 'image':
-        message_class = "user-message" if username == st.session_state.username else "other-message"
-        st.markdown(f"""
-        <div class="chat-message {message_class}">
-            <strong>{username}</strong> sent an image • {timestamp_str}<br>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        if file_data:
-            try:
-                image = Image.open(io.BytesIO(file_data))
-                st.image(image, width=300, caption=content)
-            except:
-                st.error("Could not display image")
+    edited_text = " ✏️" if is_edited else ""
+    return f'<div class="chat-message {message_class}"><strong>{html.escape(username)}</strong>{edited_text} • {timestamp_str}<br>{content}</div>'
+
+@st.cache_resource
+def get_render_cache():
+    return ByteLRUCache(ChatConfig.RENDER_CACHE_BYTES)
+
+def cached_message_html(cache, msg, viewer):
+    """message_html for a history row, reused until the message is edited"""
+    message_id, username, msg_type, content, timestamp, reply_to, is_edited = msg[:7]
+    own = username == viewer
+    # Content is part of the key so a second edit cannot serve a stale fragment
+    key = (message_id, bool(is_edited), content, own)
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = message_html(username, content, msg_type, timestamp, is_edited, own)
+        cache.put(key, fragment)
+    return fragment
+
+def message_list_blocks(messages, viewer):
+    """Group history rows into ('html', payload) runs and ('image', ...) blocks"""
+    # cache_resource lookups are not free; resolve the cache once per list
+    cache = get_render_cache()
+    blocks = []
+    fragments = []
+    for msg in messages:
+        fragments.append(cached_message_html(cache, msg, viewer))
+        (message_id, username, msg_type, content, timestamp, reply_to, is_edited, reactions,
+         attachment_sha, file_size, file_mime, file_width, file_height) = msg
+        if msg_type == 'image' and attachment_sha:
+            blocks.append(('html', ''.join(fragments)))
+            fragments = []
+            attachment = {
+                'message_id': message_id, 'sha256': attachment_sha, 'size': file_size,
+                'mime': file_mime, 'width': file_width, 'height': file_height
+            }
+            blocks.append(('image', (content, attachment)))
+    if fragments:
+        blocks.append(('html', ''.join(fragments)))
+    return blocks
+
+def display_image(caption, attachment):
+    # Pre-encoded thumbnail bytes go straight to the browser, no decode here
+    thumbnail = get_thumbnail(attachment['sha256'], ChatConfig.THUMBNAIL_SIZES[-1])
+    if thumbnail:
+        st.image(thumbnail, caption=caption)
+    elif attachment['width'] and attachment['sha256'] not in get_thumbnail_pipeline().failed:
+        st.caption(f"🖼️ Preparing image ({attachment['width']}×{attachment['height']})...")
+    else:
+        st.error("Could not display image")
+
+def render_message_list(messages):
+    """One markdown element per run of messages instead of one per message.
+
+    Images break a run so their thumbnails keep going through st.image
+    (served by URL) rather than being inlined into every payload.
+    """
+    for kind, block in message_list_blocks(messages, st.session_state.username):
+        if kind == 'html':
+            st.markdown(block, unsafe_allow_html=True)
+        else:
+            display_image(*block)
 
 def login_page():
     st.markdown('<div class="main-header">🌐 ChatVerse Pro</div>', unsafe_allow_html=True)
@@ -726,28 +2825,70 @@ def login_page():
                     else:
                         st.error("⚠️ Please fill in all required fields")
 
+def watched_channels():
+    channels = [room_channel(st.session_state.current_room), user_channel(st.session_state.username)]
+    if st.session_state.current_chat:
+        channels.append(dm_channel(st.session_state.username, st.session_state.current_chat))
+    return channels
+
+def watch_for_updates():
+    """Rerun the page once a watched channel publishes, backing off while idle"""
+    if not st.session_state.watch_armed:
+        # The first call is inline in the page run; only timed reruns check
+        st.session_state.watch_armed = True
+        return
+    
+    watched = st.session_state.watched_versions
+    if get_message_broker().versions(watched) != watched:
+        st.session_state.refresh_reason = 'signal'
+    elif time.time() - st.session_state.rendered_at >= ChatConfig.FULL_REFRESH_SECONDS:
+        st.session_state.refresh_reason = 'stale'
+    elif st.session_state.refresh_interval < ChatConfig.REFRESH_MAX_SECONDS:
+        # Nothing new: double the period (run_every only changes on a full run)
+        st.session_state.refresh_interval = min(st.session_state.refresh_interval * 2, ChatConfig.REFRESH_MAX_SECONDS)
+        st.session_state.refresh_reason = 'backoff'
+    else:
+        return
+    st.rerun()
+
 def chat_page():
-    # Auto refresh every 2 seconds
-    st_autorefresh(interval=2000, key="chat_refresh")
+    # Widget input and new messages put the watcher back on its fastest period
+    if st.session_state.pop('refresh_reason', 'input') in ('input', 'signal'):
+        st.session_state.refresh_interval = ChatConfig.REFRESH_MIN_SECONDS
+    
+    # Remember what this run rendered; the watcher compares against it in memory
+    st.session_state.watched_versions = get_message_broker().versions(watched_channels())
+    st.session_state.rendered_at = time.time()
+    st.session_state.watch_armed = False
+    st.fragment(watch_for_updates, run_every=st.session_state.refresh_interval)()
+    
+    # Every badge on the page comes from this one read
+    unread = st.session_state.unread_counts = get_unread_counts(st.session_state.username)
+    badges = {
+        "💬 Group Chat": sum(count for conversation, count in unread.items() if conversation.startswith("room:")),
+        "👥 Direct Messages": sum(count for conversation, count in unread.items() if conversation.startswith("dm:")),
+        "🔔 Notifications": unread.get(NOTIFICATION_FEED, 0),
+    }
     
-    # Main tabs
-    tab1, tab2, tab3, tab4, tab5 = st.tabs([
+    # Main views; unlike st.tabs only the selected one runs its queries
+    view = st.radio("View", [
         "💬 Group Chat", 
         "👥 Direct Messages", 
         "🔍 Discover People", 
         "👨‍💼 My Profile",
         "🔔 Notifications"
-    ])
+    ], key="active_tab", horizontal=True, label_visibility="collapsed",
+        format_func=lambda option: f"{option} ({badges[option]})" if badges.get(option) else option)
     
-    with tab1:
+    if view == "💬 Group Chat":
         render_group_chat()
-    with tab2:
+    elif view == "👥 Direct Messages":
         render_direct_messages()
-    with tab3:
+    elif view == "🔍 Discover People":
         render_discover_people()
-    with tab4:
+    elif view == "👨‍💼 My Profile":
         render_my_profile()
-    with tab5:
+    elif view == "🔔 Notifications":
         render_notifications()
 
 def render_group_chat():
@@ -778,7 +2919,9 @@ def render_group_chat():
             with st.expander(f"📁 {category.title()}"):
                 category_rooms = [room for room in rooms if room[3] == category]
                 for room_name, description, created_by, cat in category_rooms:
-                    if st.button(f"#{room_name}", key=f"room_{room_name}", use_container_width=True):
+                    unread = st.session_state.unread_counts.get(room_conversation(room_name))
+                    label = f"#{room_name} ({unread})" if unread and room_name != st.session_state.current_room else f"#{room_name}"
+                    if st.button(label, key=f"room_{room_name}", use_container_width=True):
                         st.session_state.current_room = room_name
                         update_user_session(st.session_state.username, room_name)
                         st.rerun()
@@ -819,14 +2962,16 @@ def render_group_chat():
         # Chat messages container
         with st.container():
             st.subheader("💭 Group Messages")
-            messages = get_message_history(st.session_state.current_room)
+            messages = load_conversation(st.session_state.current_room)
             
             if not messages:
                 st.info("💬 No messages yet. Start the conversation!")
             else:
-                for msg in messages:
-                    username, msg_type, content, file_data, timestamp, reply_to, is_edited, reactions = msg
-                    display_message(username, content, msg_type, file_data, timestamp, reply_to, is_edited, reactions)
+                if has_older_messages(st.session_state.current_room):
+                    if st.button("⬆️ Load older messages", key="older_group"):
+                        load_older_messages(st.session_state.current_room)
+                render_message_list(messages)
+            mark_conversation_read(st.session_state.username, st.session_state.current_room)
     
     with col2:
         # Quick actions and room info
@@ -884,13 +3029,32 @@ def render_direct_messages():
     col1, col2 = st.columns([1, 2])
     
     with col1:
+        # Recent conversations first, newest on top, from the conversation index
+        conversations = get_conversations(st.session_state.username)
+        if conversations:
+            st.subheader("💬 Conversations")
+        for peer, avatar, status, sender, message_type, content, timestamp, unread in conversations:
+            status_dot = "🟢" if status == 'online' else "🔴"
+            badge = f" 💬 {unread}" if unread and peer != st.session_state.current_chat else ""
+            if st.button(f"{status_dot} {avatar} {peer}{badge}", key=f"dm_{peer}", use_container_width=True):
+                st.session_state.current_chat = peer
+                st.rerun()
+            preview = "📷 Image" if message_type == 'image' else content
+            if sender == st.session_state.username:
+                preview = f"You: {preview}"
+            preview = preview[:40] + "..." if len(preview) > 40 else preview
+            st.caption(f"{preview} · {format_timestamp(timestamp)}")
+        
         st.subheader("� Friends List")
         friends = get_friends(st.session_state.username)
         
         if not friends:
             st.info("👋 No friends yet. Go to Discover tab to find people!")
         else:
+            talked_to = {row[0] for row in conversations}
             for friend_username, avatar, status, bio, last_seen in friends:
+                if friend_username in talked_to:
+                    continue
                 status_dot = "🟢" if status == 'online' else "🔴"
                 if st.button(f"{status_dot} {avatar} {friend_username}", key=f"dm_{friend_username}", use_container_width=True):
                     st.session_state.current_chat = friend_username
@@ -902,16 +3066,18 @@ def render_direct_messages():
             st.subheader(f"💬 Chat with {st.session_state.current_chat}")
             
             # Display direct messages
-            messages = get_message_history("direct", target_user=st.session_state.current_chat)
+            messages = load_conversation("direct", target_user=st.session_state.current_chat)
             
             chat_container = st.container(height=400)
             with chat_container:
                 if not messages:
                     st.info("💭 No messages yet. Start the conversation!")
                 else:
-                    for msg in messages:
-                        username, msg_type, content, file_data, timestamp, reply_to, is_edited, reactions = msg
-                        display_message(username, content, msg_type, file_data, timestamp, reply_to, is_edited, reactions)
+                    if has_older_messages("direct", target_user=st.session_state.current_chat):
+                        if st.button("⬆️ Load older messages", key="older_dm"):
+                            load_older_messages("direct", target_user=st.session_state.current_chat)
+                    render_message_list(messages)
+            mark_conversation_read(st.session_state.username, "direct", target_user=st.session_state.current_chat)
             
             # Direct message input
             col1, col2 = st.columns([4, 1])
@@ -940,9 +3106,10 @@ def render_direct_messages():
 def render_discover_people():
     st.markdown('<div class="main-header">🔍 Discover People</div>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3 = st.tabs(["👥 Recommended", "🌐 Online Users", "📨 Friend Requests"])
+    view = st.radio("Discover", ["👥 Recommended", "🌐 Online Users", "📨 Friend Requests"],
+                    key="discover_tab", horizontal=True, label_visibility="collapsed")
     
-    with tab1:
+    if view == "👥 Recommended":
         st.subheader("💫 People You May Know")
         recommendations = get_user_recommendations(st.session_state.username)
         
@@ -966,10 +3133,11 @@ def render_discover_people():
                                 st.error("❌ Could not send friend request")
                     st.markdown("---")
     
-    with tab2:
+    elif view == "🌐 Online Users":
         st.subheader("🌐 Currently Online")
         online_users = get_online_users()
         online_users = [user for user in online_users if user[0] != st.session_state.username]
+        friends = get_friend_set(st.session_state.username)
         
         if not online_users:
             st.info("😴 No one is online right now. Check back later!")
@@ -984,14 +3152,16 @@ def render_discover_people():
                         st.caption("🟢 Online Now")
                         st.caption(bio[:50] + "..." if len(bio) > 50 else bio)
                     with col3:
-                        if st.button("👋 Connect", key=f"online_{username}"):
+                        if username in friends:
+                            st.caption("🤝 Friends")
+                        elif st.button("👋 Connect", key=f"online_{username}"):
                             if send_friend_request(st.session_state.username, username, "Hi! Saw you're online and wanted to connect."):
                                 st.success(f"✅ Friend request sent to {username}!")
                             else:
                                 st.error("❌ Could not send friend request")
                     st.markdown("---")
     
-    with tab3:
+    elif view == "📨 Friend Requests":
         st.subheader("📨 Pending Friend Requests")
         friend_requests = get_friend_requests(st.session_state.username)
         
@@ -1049,8 +3219,7 @@ def render_my_profile():
             st.info(f"**Location:** {location}")
             
             # Friends count
-            friends = get_friends(st.session_state.username)
-            st.metric("Friends", len(friends))
+            st.metric("Friends", len(get_friend_set(st.session_state.username)))
             
             # Edit profile
             with st.expander("✏️ Edit Profile"):
@@ -1059,15 +3228,7 @@ def render_my_profile():
                 new_location = st.text_input("Location", value=location)
                 
                 if st.button("Update Profile"):
-                    # Update profile in database
-                    conn = init_database()
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE users SET bio = ?, interests = ?, location = ? WHERE username = ?",
-                        (new_bio, new_interests, new_location, st.session_state.username)
-                    )
-                    conn.commit()
-                    conn.close()
+                    update_user_profile(st.session_state.username, new_bio, new_interests, new_location)
                     st.success("✅ Profile updated successfully!")
                     st.rerun()
 
@@ -1079,7 +3240,7 @@ def render_notifications():
     if not notifications:
         st.info("📭 No notifications")
     else:
-        unread_count = sum(1 for notif in notifications if not notif[3])
+        unread_count = st.session_state.unread_counts.get(NOTIFICATION_FEED, 0)
         if unread_count > 0:
             st.success(f"🔔 You have {unread_count} unread notifications")
             
@@ -1092,13 +3253,15 @@ def render_notifications():
             st.markdown(f"""
             <div class="notification">
                 {read_icon} <strong>{content}</strong><br>
-                <small>{created_at[:16]}</small>
+                <small>{format_timestamp(created_at)}</small>
             </div>
             """, unsafe_allow_html=True)
 
 def main():
-    # Initialize database
-    init_database()
+    # Initialize database (schema is created once per process)
+    get_connection_pool()
+    # Start relaying other workers' messages into this process's broker
+    get_change_feed()
     
     if not st.session_state.authenticated:
         login_page()
@@ -1107,11 +3270,461 @@ def main():
         with st.sidebar:
             st.markdown("---")
             if st.button("🚪 Logout", use_container_width=True):
+                get_presence_registry().leave(st.session_state.username)
                 st.session_state.authenticated = False
                 st.session_state.username = None
+                st.session_state.message_cache = {}
                 st.rerun()
         
         chat_page()
 
+# Maintenance commands: python Chat_App.py <command> [options]
+def cli_migrate(args):
+    conn = sqlite3.connect(args.db)
+    try:
+        applied = run_migrations(conn, args.target_version)
+        for version, description, duration_ms in applied:
+            print(f"  v{version:<3} {description:<50} {duration_ms:10.1f} ms")
+        total_ms = sum(duration_ms for _, _, duration_ms in applied)
+        print(f"Schema at version {get_schema_version(conn.cursor())}: {len(applied)} step(s) applied in {total_ms:.1f} ms")
+        for name, duration_ms in run_schema_rebuilds(conn):
+            print(f"  Rebuilt {name} in {duration_ms:.1f} ms")
+    finally:
+        conn.close()
+
+def cli_verify_plans(args):
+    failures = 0
+    for helper, sql, plan, scans in verify_query_plans(args.user):
+        status = "FAIL" if scans else "ok"
+        failures += bool(scans)
+        print(f"[{status}] {helper}: {sql}")
+        for detail in plan:
+            print(f"         {detail}")
+    if failures:
+        print(f"{failures} statement(s) fall back to a table scan")
+        sys.exit(1)
+    print("All helper queries are served by indexes")
+
+def cli_gc_attachments(args):
+    removed = collect_attachment_garbage(args.min_age)
+    print(f"Removed {removed} unreferenced attachment file(s)")
+
+@contextmanager
+def scratch_database():
+    """Point the app at a throwaway database so benchmarks never touch real data"""
+    with tempfile.TemporaryDirectory() as directory:
+        ChatConfig.DB_PATH = os.path.join(directory, 'benchmark.db')
+        yield ChatConfig.DB_PATH
+
+def create_benchmark_users(usernames):
+    """Accounts for synthetic senders; messages must point at a users row"""
+    with db_connection() as conn:
+        conn.executemany("INSERT OR IGNORE INTO users (username, password) VALUES (?, '')", [(username,) for username in usernames])
+        commit(conn)
+
+def benchmark_writes(messages, threads):
+    """Sustained save_message throughput, committing per call vs write-behind"""
+    per_thread = messages // threads
+    
+    def sender(username):
+        for i in range(per_thread):
+            save_message('general', username, 'text', f"benchmark message {i}")
+    
+    create_benchmark_users([f"bench{i}" for i in range(threads)])
+    results = []
+    for label, write_behind in (("commit per call", False), ("write-behind", True)):
+        ChatConfig.WRITE_BEHIND = write_behind
+        pool = get_connection_pool()
+        commits = pool.commits
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(sender, [f"bench{i}" for i in range(threads)]))
+        elapsed = time.perf_counter() - started
+        sent = per_thread * threads
+        results.append((label, sent / elapsed, (pool.commits - commits) / sent))
+    return results
+
+# Journal settings compared by benchmark-concurrency
+CONCURRENCY_BENCHMARK_CONFIGS = {
+    'rollback journal': {**ChatConfig.PRAGMAS, 'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+    'WAL, synchronous=FULL': {**ChatConfig.PRAGMAS, 'synchronous': 'FULL'},
+    'WAL, synchronous=NORMAL': ChatConfig.PRAGMAS,
+}
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float('nan')
+
+def benchmark_concurrency(pragmas, readers, writers, duration):
+    """Readers refresh room history while writers send messages, for duration seconds.
+
+    Returns {'read': [...], 'write': [...]} latencies in ms and the number
+    of operations that failed with "database is locked".
+    """
+    get_connection_pool.clear()
+    ChatConfig.PRAGMAS = pragmas
+    create_benchmark_users(['seed'] + [f"writer{i}" for i in range(writers)])
+    for i in range(200):
+        save_message('general', 'seed', 'text', f"seed message {i}")
+    
+    latencies = {'read': [], 'write': []}
+    errors = [0]
+    stop_at = time.perf_counter() + duration
+    
+    def worker(role, username):
+        samples = latencies[role]
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                if role == 'read':
+                    get_message_history('general')
+                else:
+                    save_message('general', username, 'text', "benchmark message")
+            except sqlite3.OperationalError:
+                errors[0] += 1
+                continue
+            samples.append((time.perf_counter() - started) * 1000)
+    
+    roles = [('read', f"reader{i}") for i in range(readers)] + [('write', f"writer{i}") for i in range(writers)]
+    with ThreadPoolExecutor(max_workers=len(roles)) as executor:
+        list(executor.map(lambda role: worker(*role), roles))
+    return latencies, errors[0]
+
+def cli_benchmark_concurrency(args):
+    print(f"{args.readers} readers, {args.writers} writers, {args.duration}s per configuration")
+    print(f"  {'configuration':<26}{'reads':>8}{'p50':>8}{'p99':>9}{'writes':>9}{'p50':>8}{'p99':>9}{'locked':>8}")
+    for label, pragmas in CONCURRENCY_BENCHMARK_CONFIGS.items():
+        with scratch_database():
+            latencies, errors = benchmark_concurrency(pragmas, args.readers, args.writers, args.duration)
+            get_connection_pool.clear()
+        reads, writes = latencies['read'], latencies['write']
+        print(
+            f"  {label:<26}{len(reads):>8}{percentile(reads, 0.5):>8.1f}{percentile(reads, 0.99):>9.1f}"
+            f"{len(writes):>9}{percentile(writes, 0.5):>8.1f}{percentile(writes, 0.99):>9.1f}{errors:>8}"
+        )
+
+def cli_benchmark_writes(args):
+    with scratch_database():
+        results = benchmark_writes(args.messages, args.threads)
+        batches = get_message_writer().batches_committed
+    
+    print(f"{args.messages} messages from {args.threads} concurrent senders")
+    for label, rate, commits_per_message in results:
+        print(f"  {label:<16} {rate:10.0f} msg/s {commits_per_message:8.3f} commits/msg")
+    print(f"  speedup          {results[1][1] / results[0][1]:10.1f}x ({batches} group commits)")
+
+def cli_rebuild_recommendations(args):
+    started = time.perf_counter()
+    with unit_of_work() as conn:
+        rows = rebuild_recommendations(conn.cursor())
+    print(f"Rebuilt {rows} recommendation(s) in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def seed_social_graph(users, friends_per_user, interactions_per_user, seed=42):
+    """Fill the database with synthetic users, friendships and interactions"""
+    rng = random.Random(seed)
+    topics = [f"topic{i}" for i in range(50)]
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO users (username, password, interests, profile_views) VALUES (?, '', ?, ?)",
+            [(f"user{i}", ', '.join(rng.sample(topics, 3)), rng.randrange(1000)) for i in range(users)]
+        )
+        cursor.execute("SELECT username, id FROM users")
+        ids = dict(cursor.fetchall())
+        user_ids = [ids[f"user{i}"] for i in range(users)]
+        
+        def random_pairs(count):
+            pairs = set()
+            while len(pairs) < count:
+                a, b = rng.choice(user_ids), rng.choice(user_ids)
+                if a != b:
+                    pairs.add((min(a, b), max(a, b)))
+            return pairs
+        
+        friendships = random_pairs(users * friends_per_user)
+        cursor.executemany("INSERT INTO friends (user1_id, user2_id, status) VALUES (?, ?, 'accepted')", friendships)
+        cursor.executemany(
+            "INSERT INTO friend_edges (user_id, friend_id) VALUES (?, ?)",
+            [edge for a, b in friendships for edge in ((a, b), (b, a))]
+        )
+        cursor.executemany(
+            "INSERT INTO user_interactions (user1_id, user2_id, interaction_type) VALUES (?, ?, 'message')",
+            random_pairs(users * interactions_per_user)
+        )
+
+def benchmark_recommendations(users, lookups):
+    """Rebuild time, then per-lookup latency of the index vs the previous query"""
+    # The query the index replaced, on today's id columns
+    previous_query = '''
+        SELECT u.username, u.avatar, u.bio, u.status,
+               COUNT(DISTINCT ui.interaction_type) as common_interactions
+        FROM users u
+        LEFT JOIN user_interactions ui ON (ui.user1_id = ? AND ui.user2_id = u.id)
+                                      OR (ui.user2_id = ? AND ui.user1_id = u.id)
+        WHERE u.id != ?
+          AND u.id NOT IN (
+              SELECT CASE WHEN user1_id = ? THEN user2_id ELSE user1_id END
+              FROM friends
+              WHERE user1_id = ? OR user2_id = ?
+          )
+        GROUP BY u.id
+        ORDER BY common_interactions DESC, u.profile_views DESC
+        LIMIT 5
+    '''
+    seed_social_graph(users, friends_per_user=2, interactions_per_user=1)
+    rng = random.Random(7)
+    sample = [f"user{rng.randrange(users)}" for _ in range(lookups)]
+    results = {}
+    
+    started = time.perf_counter()
+    with unit_of_work() as conn:
+        results['index rows'] = rebuild_recommendations(conn.cursor())
+    results['rebuild ms'] = (time.perf_counter() - started) * 1000
+    
+    def timed(call, usernames):
+        samples = []
+        for username in usernames:
+            started = time.perf_counter()
+            call(username)
+            samples.append((time.perf_counter() - started) * 1000)
+        return samples
+    
+    with db_connection() as conn:
+        results['index lookup'] = timed(get_user_recommendations, sample)
+        results['previous query'] = timed(
+            lambda username: conn.execute(previous_query, (get_user_id(username),) * 6).fetchall(),
+            sample[:max(1, lookups // 50)]
+        )
+        # Incremental maintenance for new friendships, rolled back afterwards
+        pairs = [(get_user_id(f"user{rng.randrange(users)}"), get_user_id(f"user{rng.randrange(users)}")) for _ in range(lookups)]
+        results['index_friendship'] = timed(lambda pair: index_friendship(conn.cursor(), *pair), pairs)
+        conn.rollback()
+    return results
+
+def cli_benchmark_recommendations(args):
+    with scratch_database():
+        results = benchmark_recommendations(args.users, args.lookups)
+        get_connection_pool.clear()
+    
+    print(f"{args.users} users: {results['index rows']} index rows rebuilt in {results['rebuild ms']:.0f} ms")
+    print(f"  {'operation':<20}{'calls':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for label in ('index lookup', 'previous query', 'index_friendship'):
+        samples = results[label]
+        print(f"  {label:<20}{len(samples):>8}{percentile(samples, 0.5):>10.2f}{percentile(samples, 0.99):>10.2f}")
+
+# Hot queries compared by benchmark-user-ids:
+# label -> (username columns, id columns, params for (room, user, peer))
+USER_ID_BENCHMARK_QUERIES = {
+    'room page': (
+        '''SELECT id, username, content, timestamp FROM messages
+           WHERE room = ? AND target_user IS NULL ORDER BY timestamp DESC, id DESC LIMIT 50''',
+        '''SELECT id, user_id, content, timestamp FROM messages
+           WHERE room = ? AND target_id IS NULL ORDER BY timestamp DESC, id DESC LIMIT 50''',
+        lambda room, user, peer: (room,),
+    ),
+    'direct messages': (
+        '''SELECT * FROM (SELECT id, username, content, timestamp FROM messages WHERE username = ? AND target_user = ?
+                          ORDER BY timestamp DESC, id DESC LIMIT 50)
+           UNION ALL
+           SELECT * FROM (SELECT id, username, content, timestamp FROM messages WHERE username = ? AND target_user = ?
+                          ORDER BY timestamp DESC, id DESC LIMIT 50)
+           ORDER BY timestamp DESC, id DESC LIMIT 50''',
+        '''SELECT * FROM (SELECT id, user_id, content, timestamp FROM messages WHERE user_id = ? AND target_id = ?
+                          ORDER BY timestamp DESC, id DESC LIMIT 50)
+           UNION ALL
+           SELECT * FROM (SELECT id, user_id, content, timestamp FROM messages WHERE user_id = ? AND target_id = ?
+                          ORDER BY timestamp DESC, id DESC LIMIT 50)
+           ORDER BY timestamp DESC, id DESC LIMIT 50''',
+        lambda room, user, peer: (user, peer, peer, user),
+    ),
+    'friends': (
+        '''SELECT u.username, u.avatar, u.status FROM friend_edges e
+           JOIN users u ON u.username = e.friend WHERE e.username = ?''',
+        '''SELECT u.username, u.avatar, u.status FROM friend_edges e
+           JOIN users u ON u.id = e.friend_id WHERE e.user_id = ?''',
+        lambda room, user, peer: (user,),
+    ),
+    'notifications': (
+        "SELECT type, content, created_at FROM notifications WHERE username = ? ORDER BY created_at DESC LIMIT 20",
+        "SELECT type, content, created_at FROM notifications WHERE user_id = ? ORDER BY created_at DESC LIMIT 20",
+        lambda room, user, peer: (user,),
+    ),
+}
+
+def seed_username_schema(conn, users, messages, seed=42):
+    """Fill a schema version 9 database, where rows name users by username"""
+    rng = random.Random(seed)
+    names = [f"member{i:07d}" for i in range(users)]
+    rooms = [row[0] for row in conn.execute("SELECT name FROM rooms")]
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, '')", [(name,) for name in names])
+    
+    friendships = set()
+    while len(friendships) < users * 5:
+        a, b = rng.sample(names, 2)
+        friendships.add((min(a, b), max(a, b)))
+    friendships = sorted(friendships)
+    conn.executemany("INSERT INTO friends (user1, user2, status) VALUES (?, ?, 'accepted')", friendships)
+    conn.executemany(
+        "INSERT INTO friend_edges (username, friend) VALUES (?, ?)",
+        [edge for a, b in friendships for edge in ((a, b), (b, a))]
+    )
+    conn.executemany(
+        "INSERT INTO user_interactions (user1, user2, interaction_type) VALUES (?, ?, 'message')",
+        friendships[::5]
+    )
+    conn.executemany(
+        "INSERT INTO user_sessions (username, session_id, room) VALUES (?, ?, ?)",
+        [(name, name, rng.choice(rooms)) for name in names]
+    )
+    
+    rows = []
+    for i in range(messages):
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + i * 7))
+        content = f"benchmark message {i} with a few words of text"
+        if i % 4 == 0:
+            sender, target = rng.choice(friendships)[::rng.choice((1, -1))]
+            rows.append(('direct', sender, target, content, timestamp))
+        else:
+            rows.append((rng.choice(rooms), rng.choice(names), None, content, timestamp))
+    conn.executemany("INSERT INTO messages (room, username, target_user, content, timestamp) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.executemany(
+        "INSERT INTO notifications (username, type, content, created_at) VALUES (?, 'friend_request', ?, ?)",
+        [(target, f"{sender} sent you a friend request!", timestamp) for room, sender, target, content, timestamp in rows[::8] if target]
+    )
+    conn.commit()
+    return rooms, friendships
+
+def benchmark_user_ids(users, messages, lookups):
+    """File size and hot query latency of the same data keyed by username, then by user id"""
+    results = {}
+    with scratch_database() as path:
+        conn = sqlite3.connect(path)
+        try:
+            run_migrations(conn, 9)
+            rooms, friendships = seed_username_schema(conn, users, messages)
+            rng = random.Random(7)
+            samples = [(rng.choice(rooms), *rng.choice(friendships)) for _ in range(lookups)]
+            
+            for phase in ('usernames', 'user ids'):
+                if phase == 'user ids':
+                    results['migration ms'] = sum(duration_ms for _, _, duration_ms in run_migrations(conn, 10))
+                    ids = dict(conn.execute("SELECT username, id FROM users"))
+                    samples = [(room, ids[user], ids[peer]) for room, user, peer in samples]
+                conn.execute("VACUUM")
+                results[phase] = {'bytes': os.path.getsize(path)}
+                for label, (by_name, by_id, params) in USER_ID_BENCHMARK_QUERIES.items():
+                    sql = by_id if phase == 'user ids' else by_name
+                    timings = []
+                    for sample in samples:
+                        started = time.perf_counter()
+                        conn.execute(sql, params(*sample)).fetchall()
+                        timings.append((time.perf_counter() - started) * 1000)
+                    results[phase][label] = timings
+        finally:
+            conn.close()
+    return results
+
+def cli_benchmark_user_ids(args):
+    results = benchmark_user_ids(args.users, args.messages, args.lookups)
+    before, after = results['usernames'], results['user ids']
+    print(f"{args.users} users, {args.messages} messages; migration to user ids took {results['migration ms']:.0f} ms")
+    print(f"  {'':<28}{'usernames':>12}{'user ids':>12}")
+    print(f"  {'database size (MB)':<28}{before['bytes'] / 2**20:>12.1f}{after['bytes'] / 2**20:>12.1f}")
+    for label in USER_ID_BENCHMARK_QUERIES:
+        print(f"  {label + ' p50 (ms)':<28}{percentile(before[label], 0.5):>12.3f}{percentile(after[label], 0.5):>12.3f}")
+
+def markdown_delta_bytes(body):
+    """Size of the message Streamlit sends to the browser for one st.markdown call"""
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+    msg = ForwardMsg()
+    msg.delta.new_element.markdown.body = body
+    msg.delta.new_element.markdown.allow_html = True
+    return msg.ByteSize()
+
+def benchmark_render(messages, refreshes):
+    """Per refresh: ms, markdown elements and bytes sent, per message vs batched"""
+    rows = [
+        (i, f"user{i % 7}", 'text', f"benchmark message {i} " * 4, 1704110400000 + i * 1000,
+         None, i % 10 == 0, '{}', None, None, None, None, None)
+        for i in range(messages)
+    ]
+    viewer = 'user0'
+    
+    def per_message():
+        return [markdown_delta_bytes(message_html(row[1], row[3], row[2], row[4], row[6], row[1] == viewer)) for row in rows]
+    
+    def batched():
+        return [markdown_delta_bytes(block) for kind, block in message_list_blocks(rows, viewer)]
+    
+    results = []
+    get_render_cache.clear()
+    for label, render, runs in (("per message", per_message, refreshes), ("batched, cold cache", batched, 1), ("batched, warm cache", batched, refreshes)):
+        started = time.perf_counter()
+        for _ in range(runs):
+            payload = render()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / runs
+        results.append((label, elapsed_ms, len(payload), sum(payload)))
+    return results
+
+def cli_benchmark_render(args):
+    print(f"{args.messages} messages per refresh, {args.refreshes} refreshes")
+    print(f"  {'path':<22}{'ms':>8}{'elements':>10}{'bytes':>10}")
+    for label, elapsed_ms, elements, payload_bytes in benchmark_render(args.messages, args.refreshes):
+        print(f"  {label:<22}{elapsed_ms:>8.2f}{elements:>10}{payload_bytes:>10}")
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog="Chat_App.py", description="ChatVerse Pro maintenance commands")
+    parser.add_argument("--db", default=ChatConfig.DB_PATH, help="SQLite database file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate", help="apply pending schema migrations and report their timings")
+    migrate.add_argument("--to", type=int, dest="target_version", help="stop after this schema version")
+    migrate.set_defaults(handler=cli_migrate)
+
+    verify = commands.add_parser("verify-plans", help="EXPLAIN every helper query and fail on table scans")
+    verify.add_argument("--user", default="plan-check", help="username passed to the helpers")
+    verify.set_defaults(handler=cli_verify_plans)
+
+    gc = commands.add_parser("gc-attachments", help="delete attachment files no message refers to")
+    gc.add_argument("--min-age", type=int, default=3600, help="keep untracked files younger than this many seconds")
+    gc.set_defaults(handler=cli_gc_attachments)
+
+    bench_writes = commands.add_parser("benchmark-writes", help="compare save_message throughput with and without write-behind")
+    bench_writes.add_argument("--messages", type=int, default=2000)
+    bench_writes.add_argument("--threads", type=int, default=8)
+    bench_writes.set_defaults(handler=cli_benchmark_writes)
+
+    bench_concurrency = commands.add_parser("benchmark-concurrency", help="p50/p99 latency of concurrent readers and writers per journal configuration")
+    bench_concurrency.add_argument("--readers", type=int, default=8)
+    bench_concurrency.add_argument("--writers", type=int, default=2)
+    bench_concurrency.add_argument("--duration", type=float, default=5.0, help="seconds per configuration")
+    bench_concurrency.set_defaults(handler=cli_benchmark_concurrency)
+
+    bench_render = commands.add_parser("benchmark-render", help="time and payload size of rendering a message list per message vs batched")
+    bench_render.add_argument("--messages", type=int, default=100)
+    bench_render.add_argument("--refreshes", type=int, default=200)
+    bench_render.set_defaults(handler=cli_benchmark_render)
+
+    rebuild = commands.add_parser("rebuild-recommendations", help="recompute the people-you-may-know index from scratch")
+    rebuild.set_defaults(handler=cli_rebuild_recommendations)
+
+    bench_recommendations = commands.add_parser("benchmark-recommendations", help="rebuild time and lookup latency of the recommendation index")
+    bench_recommendations.add_argument("--users", type=int, default=100000)
+    bench_recommendations.add_argument("--lookups", type=int, default=1000)
+    bench_recommendations.set_defaults(handler=cli_benchmark_recommendations)
+
+    bench_user_ids = commands.add_parser("benchmark-user-ids", help="database size and query time keyed by username vs integer user id")
+    bench_user_ids.add_argument("--users", type=int, default=20000)
+    bench_user_ids.add_argument("--messages", type=int, default=500000)
+    bench_user_ids.add_argument("--lookups", type=int, default=2000)
+    bench_user_ids.set_defaults(handler=cli_benchmark_user_ids)
+
+    args = parser.parse_args(argv)
+    ChatConfig.DB_PATH = args.db
+    args.handler(args)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file